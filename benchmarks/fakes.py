@@ -0,0 +1,176 @@
+"""
+Stand-ins for the discord.py objects the command handlers touch.
+
+They carry only the attributes and coroutines the handlers use, and
+never talk to Discord. `latency` adds a simulated round trip to every
+call that would have been an HTTP request.
+"""
+
+import asyncio
+import itertools
+
+_ids = itertools.count(10 ** 17)
+
+# Calls made that would have been HTTP requests.
+requests = 0
+
+
+def next_id() -> int:
+    """
+    Return a new snowflake-sized id.
+    """
+
+    return next(_ids)
+
+
+class Permissions:
+    __slots__ = ("manage_roles",)
+
+    def __init__(
+            self,
+            manage_roles: bool = False):
+        self.manage_roles = manage_roles
+
+
+class Guild:
+    def __init__(
+            self,
+            id: int = None,
+            latency: float = 0.0):
+        self.id = id or next_id()
+        self.latency = latency
+        self.roles = []
+
+    def add_role(
+            self,
+            name: str) -> "Role":
+        role = Role(self, name, position=len(self.roles))
+        self.roles.append(role)
+        return role
+
+    async def create_role(
+            self,
+            name: str,
+            **kwargs) -> "Role":
+        await _request(self.latency)
+        return self.add_role(name)
+
+
+class Role:
+    __slots__ = ("id", "name", "guild", "position")
+
+    def __init__(
+            self,
+            guild: Guild,
+            name: str,
+            position: int = 0):
+        self.id = next_id()
+        self.name = name
+        self.guild = guild
+        self.position = position
+
+    def __lt__(self, other):
+        return (self.position, self.id) < (other.position, other.id)
+
+    async def delete(self, **kwargs):
+        await _request(self.guild.latency)
+        self.guild.roles.remove(self)
+
+
+class Member:
+    __slots__ = (
+        "id", "guild", "roles", "guild_permissions",
+        "nick", "status", "activity")
+
+    def __init__(
+            self,
+            guild: Guild,
+            id: int = None,
+            manage_roles: bool = False):
+        self.id = id or next_id()
+        self.guild = guild
+        self.roles = []
+        self.guild_permissions = Permissions(manage_roles)
+        self.nick = None
+        self.status = "online"
+        self.activity = None
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+    @property
+    def _roles(self) -> tuple:
+        return tuple(role.id for role in self.roles)
+
+    def copy(self, **changes) -> "Member":
+        """
+        Return a copy with some attributes changed, like the before and
+        after pair of a member update.
+        """
+
+        member = Member(self.guild, self.id)
+        for name in Member.__slots__:
+            setattr(member, name, changes.get(name, getattr(self, name)))
+        return member
+
+    async def send(self, content: str = None, **kwargs):
+        await _request(self.guild.latency)
+
+    async def add_roles(self, *roles, **kwargs):
+        await _request(self.guild.latency)
+        self.roles.extend(roles)
+
+    async def remove_roles(self, *roles, **kwargs):
+        await _request(self.guild.latency)
+        self.roles = [role for role in self.roles if role not in roles]
+
+
+class Channel:
+    def __init__(
+            self,
+            guild: Guild):
+        self.id = next_id()
+        self.guild = guild
+        self.sent = 0
+        self.last = None
+
+    async def send(
+            self,
+            content: str = None,
+            **kwargs) -> "Message":
+        await _request(self.guild.latency)
+        self.sent += 1
+        self.last = content
+        return Message(content, None, self)
+
+
+class Message:
+    def __init__(
+            self,
+            content: str,
+            author: Member,
+            channel: Channel,
+            mentions: list = ()):
+        self.id = next_id()
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.mentions = list(mentions)
+
+    async def add_reaction(self, emoji):
+        await _request(self.guild.latency)
+
+
+async def _request(latency: float) -> None:
+    global requests
+    requests += 1
+    if latency:
+        await asyncio.sleep(latency)
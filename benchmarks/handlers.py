@@ -0,0 +1,210 @@
+"""
+Benchmark for the command handlers and the data layer under them.
+
+Builds a synthetic guild with one managed role per scale, seeds it with
+that many members through `Role.add_members`, then sends commands
+through `HackWeek.on_message` with stand-in Discord objects. Reports
+throughput and p50/p99 latency for invite, kick, grant, list and delete.
+
+Runs against fakeredis (`pip install fakeredis[lua]`) unless a Redis URL
+is given. Point `--redis-url` at a scratch database: every role the run
+creates is deleted again, but the keyspace is shared.
+
+    python -m benchmarks.handlers --scale 1000 --scale 100000
+    python -m benchmarks.handlers --redis-url redis://localhost:6379/15
+"""
+
+import time
+import asyncio
+import argparse
+
+from benchmarks import fakes
+from bot import db
+from bot import migrations
+from bot import HackWeek
+from bot.db import Role
+from bot.db import Permset
+from bot.plugins import Plugins
+from bot.plugins import load_plugins
+from bot.utils import Permission
+
+# Members written per `Role.add_members` call while seeding.
+SEED_BATCH = 1000
+
+OPERATIONS = ("invite", "kick", "grant", "list", "delete")
+
+
+def percentile(
+        samples: list,
+        q: float) -> float:
+    """
+    Return the nearest rank percentile of sorted samples.
+    """
+
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def without_rate_limits(plugins: Plugins) -> Plugins:
+    """
+    Lift every rate limit, so only the handlers are measured.
+    """
+
+    return Plugins(
+        plugins.commands,
+        plugins.timings,
+        {prefix: {"user": None, "guild": None}
+         for prefix in plugins.commands.get("on_message", {})})
+
+
+async def seed_role(
+        guild: fakes.Guild,
+        admin: fakes.Member,
+        name: str,
+        members: int) -> fakes.Role:
+    """
+    Create a managed role and give it `members` default members.
+    """
+
+    role = await guild.create_role(name)
+    await Role.create(role, admin)
+    role_entry = await Role.get(role)
+
+    for start in range(0, members, SEED_BATCH):
+        await role_entry.add_members(
+            [fakes.Member(guild)
+             for _ in range(min(SEED_BATCH, members - start))],
+            "default")
+
+    return role
+
+
+async def run_scale(
+        bot: HackWeek,
+        scale: int,
+        iterations: int,
+        mentions: int,
+        delete_samples: int,
+        latency: float) -> dict:
+    """
+    Time each operation against a role of `scale` members.
+
+    Return a dict of operation name to sorted latencies, in seconds.
+    """
+
+    guild = fakes.Guild(latency=latency)
+    channel = fakes.Channel(guild)
+    admin = fakes.Member(guild, manage_roles=True)
+
+    roles = [
+        await seed_role(guild, admin, f"bench {i}", scale)
+        for i in range(max(1, delete_samples))]
+    role = roles[0]
+    await Permset.create(role, "moderators", Permission.REMOVE_USERS)
+
+    async def send(content, users=()):
+        message = fakes.Message(content, admin, channel, users)
+        start = time.perf_counter()
+        await bot.on_message(message)
+        return time.perf_counter() - start
+
+    results = {operation: [] for operation in OPERATIONS}
+    invited = []
+
+    for _ in range(iterations):
+        users = [fakes.Member(guild) for _ in range(mentions)]
+        invited.append(users)
+        results["invite"].append(
+            await send(f"gk invite x to {role.name}", users))
+
+    for users in invited:
+        results["kick"].append(
+            await send(f"gk kick x from {role.name}", users))
+
+    for _ in range(iterations):
+        users = [fakes.Member(guild) for _ in range(mentions)]
+        results["grant"].append(await send(
+            f"gk grant permset named moderators for {role.name} to x",
+            users))
+
+    for _ in range(iterations):
+        results["list"].append(
+            await send(f"gk list permsets for {role.name}"))
+
+    for doomed in roles:
+        results["delete"].append(
+            await send(f"gk delete role named {doomed.name}"))
+
+    bot.role_names.forget(guild)
+    return {
+        operation: sorted(samples) for operation, samples in results.items()}
+
+
+async def run(args):
+    if args.redis_url:
+        bot = HackWeek(
+            redis_url=args.redis_url,
+            plugins=without_rate_limits(load_plugins()))
+        await db.load_scripts()
+    else:
+        try:
+            from fakeredis.aioredis import FakeRedis
+        except ImportError:
+            raise SystemExit(
+                "fakeredis is not installed: "
+                "pip install fakeredis[lua], or pass --redis-url.")
+        bot = HackWeek(plugins=without_rate_limits(load_plugins()))
+        db.use_client(FakeRedis())
+
+    # Bring the schema up to date, as the bot does on start, so commands
+    # are not refused.
+    await migrations.run()
+
+    print(
+        f"{'members':>9}  {'op':<7}  {'ops/s':>9}  "
+        f"{'p50 ms':>8}  {'p99 ms':>8}")
+
+    for scale in args.scale or [1000, 100000, 1000000]:
+        results = await run_scale(
+            bot,
+            scale,
+            args.iterations,
+            args.mentions,
+            args.delete_samples,
+            args.latency / 1000)
+
+        for operation, samples in results.items():
+            print(
+                f"{scale:>9}  {operation:<7}  "
+                f"{len(samples) / sum(samples):>9.0f}  "
+                f"{percentile(samples, 0.50) * 1000:>8.2f}  "
+                f"{percentile(samples, 0.99) * 1000:>8.2f}")
+
+    await db.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--scale", type=int, action="append",
+        help="members per role, may be repeated (default 1k, 100k and 1M)")
+    parser.add_argument(
+        "--redis-url",
+        help="benchmark a Redis server instead of fakeredis")
+    parser.add_argument(
+        "--iterations", type=int, default=200,
+        help="commands timed per operation")
+    parser.add_argument(
+        "--mentions", type=int, default=1,
+        help="users mentioned by each invite, kick and grant")
+    parser.add_argument(
+        "--delete-samples", type=int, default=3,
+        help="roles of the full scale seeded and deleted")
+    parser.add_argument(
+        "--latency", type=float, default=0.0,
+        help="simulated Discord round trip, in milliseconds")
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+"""
+Gateway load generator for capacity planning.
+
+Replays a trace of gateway events through an in-process `HackWeek`, via
+the same `dispatch` call the gateway uses, at the recorded times. Discord
+objects are the stand-ins from `benchmarks.fakes` and the HTTP client is
+stubbed, so nothing leaves the process. Reports sustained events per
+second, event loop lag and memory growth.
+
+A trace is JSON lines, one event per line, sorted by `at` (seconds from
+the start). Guild, member and role fields are indexes into the synthetic
+world and wrap around its size.
+
+    {"at": 0.01, "event": "message", "guild": 0, "member": 3, "content": "lol"}
+    {"at": 0.02, "event": "message", "guild": 0, "member": 3,
+     "content": "gk invite x to bench", "mentions": [8]}
+    {"at": 0.03, "event": "member_update", "guild": 1, "member": 5,
+     "change": "status"}
+    {"at": 0.04, "event": "role_delete", "guild": 1, "role": 2}
+
+Without `--trace`, a synthetic trace of mostly chatter, some commands and
+presence floods is generated; `--write-trace` saves it for later replays.
+Uses fakeredis unless `--redis-url` is given, as `benchmarks.handlers`.
+
+    python -m benchmarks.loadgen --rate 2000 --duration 30
+    python -m benchmarks.loadgen --trace recorded.jsonl --speed 4
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+import tracemalloc
+
+from benchmarks import fakes
+from benchmarks.handlers import percentile
+from bot import db
+from bot import migrations
+from bot import HackWeek
+from bot.db import Role
+from bot.plugins import load_plugins
+
+# Relative weights of what arrives on the gateway. A presence arrival
+# is a flood of `PRESENCE_BURST` updates at once.
+MIX = {
+    "chatter": 70,
+    "command": 5,
+    "presence": 23,
+    "roles": 1.5,
+    "role_delete": 0.5,
+}
+
+PRESENCE_BURST = 20
+
+CHATTER = [
+    "lol",
+    "has anyone seen the new patch notes?",
+    "gg",
+    "good morning everyone",
+    "gonna grab lunch, brb",
+]
+
+COMMANDS = [
+    "gk list permsets for bench",
+    "gk invite x to bench",
+    "gk kick x from bench",
+    "gk grant permset named default for bench to x",
+    "!ping",
+]
+
+# How often the loop lag monitor wakes up, in seconds.
+LAG_INTERVAL = 0.01
+
+
+def synthesize(
+        rate: float,
+        duration: float,
+        rng: random.Random):
+    """
+    Yield a synthetic trace with Poisson arrivals at `rate` per second.
+    """
+
+    kinds = list(MIX)
+    weights = [MIX[kind] for kind in kinds]
+    at = 0.0
+
+    while True:
+        at += rng.expovariate(rate)
+        if at >= duration:
+            return
+
+        kind = rng.choices(kinds, weights)[0]
+        guild = rng.randrange(1 << 16)
+        member = rng.randrange(1 << 24)
+
+        if kind == "chatter":
+            yield {
+                "at": at, "event": "message", "guild": guild,
+                "member": member, "content": rng.choice(CHATTER)}
+        elif kind == "command":
+            yield {
+                "at": at, "event": "message", "guild": guild,
+                "member": member, "content": rng.choice(COMMANDS),
+                "mentions": [rng.randrange(1 << 24)]}
+        elif kind == "presence":
+            for offset in range(PRESENCE_BURST):
+                yield {
+                    "at": at, "event": "member_update", "guild": guild,
+                    "member": member + offset,
+                    "change": rng.choice(("status", "activity"))}
+        elif kind == "roles":
+            yield {
+                "at": at, "event": "member_update", "guild": guild,
+                "member": member, "change": "roles"}
+        else:
+            yield {
+                "at": at, "event": "role_delete", "guild": guild,
+                "role": rng.randrange(1 << 16)}
+
+
+def read_trace(path: str):
+    with open(path) as trace:
+        for line in trace:
+            if line.strip():
+                yield json.loads(line)
+
+
+class World:
+    """
+    Synthetic guilds the trace's indexes point into.
+
+    Each guild has one managed role named "bench" holding all of its
+    members, and `roles` more roles of which every fourth is managed.
+    """
+
+    def __init__(
+            self,
+            guilds: int,
+            members: int,
+            roles: int,
+            latency: float):
+        self.guilds = [fakes.Guild(latency=latency) for _ in range(guilds)]
+        self.channels = [fakes.Channel(guild) for guild in self.guilds]
+        self.members = [
+            [fakes.Member(guild, manage_roles=True) for _ in range(members)]
+            for guild in self.guilds]
+        self.roles = roles
+
+    async def seed(self) -> None:
+        for guild, members in zip(self.guilds, self.members):
+            admin = members[0]
+            bench = guild.add_role("bench")
+            await Role.create(bench, admin)
+            await (await Role.get(bench)).add_members(members, "default")
+
+            for i in range(self.roles):
+                role = guild.add_role(f"role {i}")
+                if i % 4 == 0:
+                    await Role.create(role, admin)
+
+    def event(
+            self,
+            bot: HackWeek,
+            entry: dict) -> None:
+        """
+        Dispatch one trace entry to the bot.
+        """
+
+        index = entry["guild"] % len(self.guilds)
+        guild = self.guilds[index]
+        members = self.members[index]
+
+        if entry["event"] == "message":
+            bot.dispatch("message", fakes.Message(
+                entry["content"],
+                members[entry["member"] % len(members)],
+                self.channels[index],
+                [members[i % len(members)]
+                 for i in entry.get("mentions", ())]))
+
+        elif entry["event"] == "member_update":
+            i = entry["member"] % len(members)
+            before = members[i]
+            after = members[i] = self._change(before, entry["change"])
+            bot.dispatch("member_update", before, after)
+
+        elif entry["event"] == "role_delete":
+            # Never the managed "bench" role the commands use.
+            role = guild.roles[1 + entry["role"] % (len(guild.roles) - 1)]
+            guild.roles.remove(role)
+            bot.dispatch("guild_role_delete", role)
+
+            replacement = guild.add_role(role.name)
+            bot.dispatch("guild_role_create", replacement)
+
+    def _change(
+            self,
+            member: fakes.Member,
+            change: str) -> fakes.Member:
+        if change == "roles":
+            if member.roles:
+                return member.copy(roles=member.roles[1:])
+            return member.copy(roles=[member.guild.roles[-1]])
+        if change == "nick":
+            return member.copy(nick=f"nick {time.monotonic()}")
+        if change == "activity":
+            return member.copy(activity=f"playing {time.monotonic()}")
+        return member.copy(
+            status="idle" if member.status == "online" else "online")
+
+
+async def monitor_lag(samples: list) -> None:
+    """
+    Record how late the loop wakes up from short sleeps.
+    """
+
+    loop = asyncio.get_event_loop()
+
+    while True:
+        expected = loop.time() + LAG_INTERVAL
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+async def run(args):
+    if args.redis_url:
+        bot = HackWeek(redis_url=args.redis_url, plugins=load_plugins())
+        await db.load_scripts()
+    else:
+        try:
+            from fakeredis.aioredis import FakeRedis
+        except ImportError:
+            raise SystemExit(
+                "fakeredis is not installed: "
+                "pip install fakeredis[lua], or pass --redis-url.")
+        bot = HackWeek(plugins=load_plugins())
+        db.use_client(FakeRedis())
+
+    # Bring the schema up to date, as the bot does on start, so commands
+    # are not refused.
+    await migrations.run()
+
+    async def request(route, **kwargs):
+        await fakes._request(args.latency / 1000)
+        return {}
+
+    errors = 0
+
+    async def on_error(event, *args, **kwargs):
+        nonlocal errors
+        errors += 1
+
+    bot.http.request = request
+    bot.on_error = on_error
+
+    world = World(
+        args.guilds, args.members, args.roles, args.latency / 1000)
+    await world.seed()
+
+    # Stubbed API calls are counted with those of the stand-in objects.
+    requests = fakes.requests
+
+    if args.trace:
+        trace = read_trace(args.trace)
+    else:
+        trace = synthesize(
+            args.rate, args.duration, random.Random(args.seed))
+
+    if args.write_trace:
+        trace = list(trace)
+        with open(args.write_trace, "w") as out:
+            for entry in trace:
+                out.write(json.dumps(entry) + "\n")
+
+    if args.memory:
+        tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    lag = []
+    monitor = asyncio.ensure_future(monitor_lag(lag))
+    loop = asyncio.get_event_loop()
+
+    events = 0
+    behind = 0.0
+    start = loop.time()
+
+    for entry in trace:
+        delay = start + entry["at"] / args.speed - loop.time()
+        behind = max(behind, -delay)
+        await asyncio.sleep(max(0.0, delay))
+        world.event(bot, entry)
+        events += 1
+
+    # Wait for the handlers still running, but not for role updates
+    # sitting out their coalescing window.
+    while True:
+        pending = [
+            task for task in asyncio.all_tasks()
+            if task is not asyncio.current_task() and task is not monitor
+            and task not in bot._role_flushes]
+        if not pending:
+            break
+        await asyncio.wait(pending)
+
+    elapsed = loop.time() - start
+    monitor.cancel()
+
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await db.disconnect()
+
+    lag.sort()
+    print(f"events          {events}")
+    print(f"errors          {errors}")
+    print(f"http requests   {fakes.requests - requests}")
+    print(f"sustained       {events / elapsed:.0f} events/s")
+    print(f"max behind      {behind * 1000:.1f} ms")
+    if lag:
+        print(
+            f"loop lag        p50 {percentile(lag, 0.50) * 1000:.2f} ms, "
+            f"p99 {percentile(lag, 0.99) * 1000:.2f} ms, "
+            f"max {lag[-1] * 1000:.2f} ms")
+    if args.memory:
+        print(
+            f"memory growth   {(current - baseline) / 2 ** 20:.1f} MiB, "
+            f"peak {(peak - baseline) / 2 ** 20:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--trace",
+        help="replay a JSON lines trace instead of a synthetic one")
+    parser.add_argument(
+        "--write-trace",
+        help="save the replayed trace as JSON lines")
+    parser.add_argument(
+        "--rate", type=float, default=1000,
+        help="synthetic arrivals per second")
+    parser.add_argument(
+        "--duration", type=float, default=10,
+        help="synthetic trace length, in seconds")
+    parser.add_argument(
+        "--speed", type=float, default=1,
+        help="replay speed multiplier")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="random seed of the synthetic trace")
+    parser.add_argument(
+        "--guilds", type=int, default=10)
+    parser.add_argument(
+        "--members", type=int, default=1000,
+        help="members per guild")
+    parser.add_argument(
+        "--roles", type=int, default=20,
+        help="roles per guild besides the managed bench role")
+    parser.add_argument(
+        "--latency", type=float, default=0.0,
+        help="simulated Discord round trip, in milliseconds")
+    parser.add_argument(
+        "--redis-url",
+        help="use a Redis server instead of fakeredis")
+    parser.add_argument(
+        "--no-memory", dest="memory", action="store_false",
+        help="skip tracemalloc, which slows the bot down")
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Memory benchmark of the packed role layout against the legacy one.
+
+For each scale, writes a role with that many members in the legacy
+layout (a string key per member and permset, plus index sets), packs it
+with `bot.migrations`, and reports the used_memory growth, key count and
+bytes per member of both, along with how many member buckets kept the
+compact listpack encoding and the server's hash-max-listpack-entries
+they depend on.
+
+Needs a real Redis server, since fakeredis does not track memory. Use a
+scratch database: the roles are removed afterwards, but the measurements
+assume nothing else writes to the server meanwhile.
+
+    python -m benchmarks.memory --redis-url redis://localhost:6379/15
+"""
+
+import time
+import random
+import asyncio
+import argparse
+
+from bot import db
+from bot import migrations
+from bot.db import Role
+from bot.db import db_connection
+from bot.db import role_registry_key
+from bot.scripts import BUCKET_FILL
+from bot.utils import Permission
+
+# Members written per pipeline.
+BATCH_SIZE = 1000
+
+# Milliseconds from the Discord epoch to the first and last user ids.
+SNOWFLAKE_RANGE = (0, 50 * 365 * 24 * 3600 * 1000 // 2)
+
+PERMSETS = {
+    "administrators": Permission.all(),
+    "moderators": Permission.INVITE_USERS | Permission.REMOVE_USERS,
+    "default": Permission.default(),
+}
+
+
+def snowflakes(
+        count: int,
+        rng: random.Random):
+    """
+    Yield user ids shaped like Discord's: a timestamp, worker bits and a
+    sequence number.
+    """
+
+    for _ in range(count):
+        yield (rng.randrange(*SNOWFLAKE_RANGE) << 22) | rng.randrange(1 << 22)
+
+
+async def used_memory(db) -> int:
+    """
+    Return used_memory once lazily freed objects are gone.
+    """
+
+    while True:
+        info = await db.info("memory")
+        if not info.get("lazyfree_pending_objects"):
+            return info["used_memory"]
+        await asyncio.sleep(0.1)
+
+
+async def write_legacy(
+        db,
+        guild_id: int,
+        role_id: int,
+        members: int,
+        rng: random.Random) -> None:
+    """
+    Write a role with `members` members in the legacy layout.
+    """
+
+    role_key = f"guild:{guild_id}:role:{role_id}"
+    names = list(PERMSETS)
+
+    async with db.pipeline(transaction=False) as pipe:
+        pipe.sadd(role_registry_key(guild_id), role_id)
+        for name, permissions in PERMSETS.items():
+            pipe.set(f"{role_key}:permset:{name}", int(permissions))
+            pipe.sadd(migrations.role_permset_names_key(role_key), name)
+        await pipe.execute()
+
+        for uid in snowflakes(members, rng):
+            name = rng.choices(names, (1, 4, 95))[0]
+            pipe.set(f"{role_key}:member:{uid}", name)
+            pipe.sadd(migrations.permset_members_key(role_key, name), uid)
+            pipe.sadd(migrations.role_members_key(role_key), uid)
+            if len(pipe) >= BATCH_SIZE:
+                await pipe.execute()
+        await pipe.execute()
+
+
+async def encodings(
+        db,
+        role_key: str) -> dict:
+    """
+    Count the encodings of a role's member buckets.
+    """
+
+    async with db.pipeline(transaction=False) as pipe:
+        for key in await Role(key=role_key).bucket_keys():
+            pipe.object("encoding", key)
+        results = await pipe.execute()
+
+    counts = {}
+    for encoding in results:
+        if encoding is not None:
+            encoding = encoding.decode() \
+                if isinstance(encoding, bytes) else encoding
+            counts[encoding] = counts.get(encoding, 0) + 1
+    return counts
+
+
+async def run_scale(
+        db,
+        scale: int,
+        rng: random.Random) -> None:
+    guild_id = rng.getrandbits(60)
+    role_id = rng.getrandbits(60)
+    role_key = f"guild:{guild_id}:role:{role_id}"
+
+    base_memory = await used_memory(db)
+    base_keys = await db.dbsize()
+
+    await write_legacy(db, guild_id, role_id, scale, rng)
+    legacy_memory = await used_memory(db) - base_memory
+    legacy_keys = await db.dbsize() - base_keys
+
+    start = time.perf_counter()
+    await migrations._pack_role(db, role_key, BATCH_SIZE)
+    pack_seconds = time.perf_counter() - start
+
+    packed_memory = await used_memory(db) - base_memory
+    packed_keys = await db.dbsize() - base_keys
+    buckets = await encodings(db, role_key)
+
+    await Role(key=role_key).delete()
+
+    for layout, memory, keys in (
+            ("legacy", legacy_memory, legacy_keys),
+            ("packed", packed_memory, packed_keys)):
+        print(
+            f"{scale:>9}  {layout:<7}  {memory / 2 ** 20:>9.1f}  "
+            f"{keys:>9}  {memory / scale:>9.1f}")
+
+    print(
+        f"{'':>9}  packed in {pack_seconds:.1f}s, buckets: " +
+        ", ".join(f"{count} {name}" for name, count in buckets.items()))
+
+
+async def run(args):
+    db.connect(args.redis_url)
+    rng = random.Random(args.seed)
+
+    try:
+        async with db_connection() as client:
+            # Buckets hold up to twice BUCKET_FILL members, and only stay
+            # listpacks if the server allows that many entries.
+            config = await client.config_get("hash-max-*-entries")
+            print(
+                f"bucket fill {BUCKET_FILL}, " +
+                ", ".join(f"{name} {value}" for name, value in config.items()))
+            print(
+                f"{'members':>9}  {'layout':<7}  {'MiB':>9}  "
+                f"{'keys':>9}  {'B/member':>9}")
+
+            for scale in args.scale or [100000, 1000000]:
+                await run_scale(client, scale, rng)
+    finally:
+        await db.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--scale", type=int, action="append",
+        help="members per role, may be repeated (default 100k and 1M)")
+    parser.add_argument(
+        "--redis-url", default="redis://localhost:6379",
+        help="the Redis server to measure")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="random seed of the user ids")
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
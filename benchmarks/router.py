@@ -0,0 +1,105 @@
+"""
+Microbenchmark for message command dispatch.
+
+Compares the compiled Router against the linear `startswith` loop it
+replaced, as the number of registered commands grows. The message mix is
+mostly chatter, like the traffic the bot actually sees.
+
+    python -m benchmarks.router
+"""
+
+import random
+import timeit
+
+from bot.router import Router
+
+WORDS = [
+    "create", "delete", "update", "grant", "list", "invite", "kick",
+    "role", "permset", "named", "for", "to", "from", "members", "all",
+]
+
+CHATTER = [
+    "lol",
+    "has anyone seen the new patch notes?",
+    "gg",
+    "good morning everyone",
+    "gonna grab lunch, brb",
+    "!",
+]
+
+
+def make_prefixes(
+        count: int,
+        rng: random.Random) -> list:
+    """
+    Generate unique command prefixes shaped like the bot's own.
+    """
+
+    prefixes = {"gk help", "!ping"}
+
+    while len(prefixes) < count:
+        words = rng.sample(WORDS, rng.randint(1, 3))
+        prefixes.add(" ".join(["gk"] + words))
+
+    return sorted(prefixes)
+
+
+def make_messages(
+        prefixes: list,
+        rng: random.Random,
+        count: int = 1000,
+        commands: float = 0.1) -> list:
+    """
+    Generate a message mix with the given share of commands.
+    """
+
+    messages = []
+
+    for _ in range(count):
+        if rng.random() < commands:
+            messages.append(f"{rng.choice(prefixes)} some arguments here")
+        else:
+            messages.append(rng.choice(CHATTER))
+
+    return messages
+
+
+def linear(
+        routes: dict,
+        messages: list) -> None:
+    for content in messages:
+        for prefix, callback in routes.items():
+            if content.startswith(prefix):
+                pass
+
+
+def routed(
+        router: Router,
+        messages: list) -> None:
+    for content in messages:
+        router.match(content)
+
+
+def main():
+    rng = random.Random(0)
+
+    print(f"{'commands':>8}  {'linear ns/msg':>14}  {'router ns/msg':>14}")
+
+    for count in (8, 32, 128, 512, 2048):
+        prefixes = make_prefixes(count, rng)
+        routes = {prefix: None for prefix in prefixes}
+        router = Router(routes)
+        messages = make_messages(prefixes, rng)
+
+        results = []
+        for func, arg in ((linear, routes), (routed, router)):
+            timer = timeit.Timer(lambda: func(arg, messages))
+            loops, _ = timer.autorange()
+            best = min(timer.repeat(repeat=5, number=loops))
+            results.append(best / loops / len(messages) * 1e9)
+
+        print(f"{count:>8}  {results[0]:>14.0f}  {results[1]:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,23 @@
 import os
 import sys
 import re
+import math
+import time
+import asyncio
+import inspect
 import discord
 
-from importlib import import_module
-from redis import Redis
+from bot import db
+from bot import metrics
+from bot import migrations
+from bot import ratelimit
+from bot.db import RedisError
+from bot.plugins import Plugins
+from bot.plugins import load_plugins
+from bot.scheduler import QueueFull
+from bot.scheduler import Scheduler
+from bot.sweeper import Sweeper
+from bot.utils import RoleNames
 
 
 class HackWeek(discord.AutoShardedClient):
@@ -13,29 +26,178 @@ class HackWeek(discord.AutoShardedClient):
     and a connection to a Redis instance.
     """
 
-    def __init__(self, *args, **kwargs):
+    # Seconds over which a member's role changes are coalesced.
+    ROLE_UPDATE_WINDOW = 1.0
+
+    # Seconds between health reports to Redis.
+    HEARTBEAT_INTERVAL = 15.0
+
+    def __init__(
+            self,
+            *args,
+            redis_url: str = "redis://localhost:6379",
+            plugins: Plugins = None,
+            metrics_port: int = None,
+            metrics_host: str = "127.0.0.1",
+            cluster: int = 0,
+            prune_stale: bool = False,
+            **kwargs):
         super().__init__(*args, **kwargs)
-        self.commands = {}
+        self.cluster = cluster
+        self.started = time.time()
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics_server = None
+        self.plugins = plugins or Plugins()
+        self.role_names = RoleNames()
+        self.scheduler = Scheduler()
+        self.sweeper = Sweeper(self, prune=prune_stale)
+        self._pending_roles = {}
+        self._role_flushes = set()
+        self._reaction_watchers = {}
+        self._background = []
+        self.db = db.connect(redis_url)
+        self._instrument()
+
+    def _instrument(self):
+        """
+        Count Discord HTTP requests and expose gateway, cache, queue,
+        schema and sweeper gauges.
+        """
+
+        request = self.http.request
+
+        async def counted_request(route, **kwargs):
+            status = "error"
+            try:
+                result = await request(route, **kwargs)
+                status = "ok"
+                return result
+            except discord.HTTPException as e:
+                status = str(e.status)
+                raise
+            finally:
+                metrics.DISCORD_REQUESTS.inc(route.method, route.path, status)
+
+        self.http.request = counted_request
+
+        metrics.REGISTRY.register(metrics.Gauge(
+            "gk_gateway_latency_seconds",
+            "Heartbeat latency of each shard.",
+            ("shard",),
+            collect=lambda: {
+                (shard,): latency for shard, latency in self.latencies}))
+
+        metrics.REGISTRY.register(metrics.Gauge(
+            "gk_cache",
+            "Counters of the in process role and permset cache.",
+            ("stat",),
+            collect=lambda: {
+                (stat,): value for stat, value in db.cache.stats().items()}))
+
+        metrics.REGISTRY.register(metrics.Gauge(
+            "gk_command_queue",
+            "Commands running and waiting in the per guild queues.",
+            ("stat",),
+            collect=lambda: {
+                (stat,): value
+                for stat, value in self.scheduler.stats().items()}))
+
+        metrics.REGISTRY.register(metrics.Gauge(
+            "gk_schema",
+            "Schema version of the keyspace and progress of its migration.",
+            ("stat",),
+            collect=lambda: {
+                (stat,): value for stat, value in migrations.stats().items()}))
+
+        metrics.REGISTRY.register(metrics.Gauge(
+            "gk_sweeper",
+            "Progress of this process' keyspace consistency sweeper.",
+            ("stat",),
+            collect=lambda: {
+                (stat,): value
+                for stat, value in self.sweeper.stats().items()}))
+
+    async def start(self, *args, **kwargs):
+        """
+        Load the Redis scripts, start listening for cache invalidations,
+        running pending migrations and sweeping the keyspace, then log in
+        and connect to Discord.
+        """
+
+        await db.load_scripts()
+        self._background = [
+            self.loop.create_task(db.listen_for_invalidations()),
+            self.loop.create_task(migrations.run()),
+            self.loop.create_task(self.sweeper.run()),
+            self.loop.create_task(self._heartbeat()),
+        ]
+        if self.metrics_port:
+            self.metrics_server = await metrics.serve(
+                self.metrics_port,
+                self.metrics_host)
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        """
+        Log out of Discord, stop the background tasks, then release the
+        shared Redis pool.
+        """
+
+        await super().close()
+        for task in self._background:
+            task.cancel()
+        await asyncio.gather(*self._background, return_exceptions=True)
+        try:
+            await db.forget_cluster(self.cluster)
+        except (RedisError, OSError):
+            pass
+        await db.disconnect()
+        if self.metrics_server:
+            self.metrics_server.close()
+
+    def health(self) -> dict:
+        """
+        Describe this process' shards for the cluster status report.
+        """
+
+        latency = self.latency
+
+        return {
+            "pid": os.getpid(),
+            "shards": self.shard_ids,
+            "shard_count": self.shard_count,
+            "guilds": len(self.guilds),
+            "latency": latency if math.isfinite(latency) else None,
+            "ready": self.is_ready(),
+            "started": self.started,
+            "updated": time.time(),
+        }
+
+    async def _heartbeat(self):
+        """
+        Report health to Redis every `HEARTBEAT_INTERVAL` seconds.
+        """
+
+        while not self.is_closed():
+            try:
+                await db.report_health(self.cluster, self.health())
+            except (RedisError, OSError):
+                pass
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+
+    @property
+    def commands(self):
+        """
+        The combined, read only command tables of every plugin.
+        """
+
+        return self.plugins.commands
 
     async def on_ready(self):
-        for file in os.listdir('./bot/commands'):
-            if file.endswith('.py') and not file.startswith("__init__"):
-                module = import_module(
-                    f"bot.commands.{file[:-3]}")
-                for key, value in module.commands.items():
-                    if type(value) == list:
-                        try:
-                            self.commands[key].extend(value)
-                        except KeyError:
-                            self.commands[key] = value
-                    elif type(value) == dict:
-                        try:
-                            self.commands[key] = {
-                                **self.commands[key], **value}
-                        except KeyError:
-                            self.commands[key] = value
         print("Logged in.")
 
+    @metrics.timed_event
     async def on_message(self, message):
         """
         Called when a new message is sent.
@@ -56,15 +218,192 @@ class HackWeek(discord.AutoShardedClient):
 
             bot: An instance of the bot class.
             message: The Message object that triggered the command.
+
+        Prefixes are matched word by word, and when several match only the
+        longest one is run. Commands of one guild run one at a time, in
+        the order they were sent; see `Scheduler`. Each runs as a
+        `bot.db.UnitOfWork`, so handlers may `prefetch` their reads, and
+        `flush` its queued writes before reporting them done.
+
+        Commands are rate limited per user and guild before they run, and
+        refused while a migration that must run offline is pending.
+        Plugins may override the limits of their prefixes, as
+        (commands, seconds) per scope, or None to lift one.
+
+        rate_limits = {
+            "<COMMAND_PREFIX>": {
+                "user": (<COMMANDS>, <SECONDS>),
+                "guild": (<COMMANDS>, <SECONDS>),
+            },
+        }
+        """
+
+        route = self.plugins.router.match(message.content)
+
+        if not route:
+            return
+
+        prefix, callback = route
+
+        retry, first = await ratelimit.check(
+            message,
+            prefix,
+            self.plugins.rate_limits.get(prefix))
+
+        if retry:
+            metrics.COMMANDS_RATE_LIMITED.inc(prefix)
+            if first:
+                try:
+                    await message.add_reaction("⏳")
+                except discord.HTTPException:
+                    pass
+            return
+
+        migration = migrations.offline()
+
+        if migration:
+            await message.channel.send(
+                "GK is upgrading its database "
+                f"({migration.name}) and will be back shortly.")
+            return
+
+        key = message.guild.id if message.guild else ("dm", message.author.id)
+
+        try:
+            async with self.scheduler.slot(key):
+                with metrics.COMMAND_SECONDS.time(prefix):
+                    async with db.unit_of_work():
+                        await callback(self, message)
+        except QueueFull:
+            await message.channel.send(
+                "Too many commands are waiting in this server, "
+                "try again in a moment.")
+
+    def watch_reactions(self, message_id: int, callback):
         """
+        Call `callback(payload, added)` for every reaction added to or
+        removed from a message, until `unwatch_reactions` is called.
 
-        items = self.commands.get("on_message")
+        Built on the raw reaction events, so it works whether or not the
+        message is still in the message cache.
+        """
+
+        self._reaction_watchers[message_id] = callback
+
+    def unwatch_reactions(self, message_id: int):
+        """
+        Stop watching a message's reactions.
+        """
+
+        self._reaction_watchers.pop(message_id, None)
+
+    @metrics.timed_event
+    async def on_raw_reaction_add(self, payload):
+        """
+        Called when a reaction is added to any message.
+        """
 
-        if items and type(items) == dict:
-            for prefix, callback in items.items():
-                if message.content.startswith(prefix):
-                    await callback(self, message)
+        callback = self._reaction_watchers.get(payload.message_id)
+        if callback:
+            callback(payload, True)
+
+    @metrics.timed_event
+    async def on_raw_reaction_remove(self, payload):
+        """
+        Called when a reaction is removed from any message.
+        """
+
+        callback = self._reaction_watchers.get(payload.message_id)
+        if callback:
+            callback(payload, False)
+
+    @metrics.timed_event
+    async def on_guild_available(self, guild):
+        """
+        Called when a guild becomes available, such as after a shard
+        reconnects with a new session.
+
+        Role events missed while disconnected are never sent, and the
+        guild's Role objects are replaced, so its name index is rebuilt.
+        """
 
+        self.role_names.forget(guild)
+
+    @metrics.timed_event
+    async def on_guild_join(self, guild):
+        """
+        Called when the bot joins a guild.
+        """
+
+        self.role_names.forget(guild)
+
+    @metrics.timed_event
+    async def on_guild_role_create(self, role):
+        """
+        Called when a role is created in a guild.
+        """
+
+        self.role_names.add(role)
+
+    @metrics.timed_event
+    async def on_guild_role_update(self, before, after):
+        """
+        Called when a role in a guild is changed.
+        """
+
+        if before.name != after.name:
+            self.role_names.remove(before)
+            self.role_names.add(after)
+
+    @metrics.timed_event
+    async def on_guild_remove(self, guild):
+        """
+        Called when the bot leaves or is removed from a guild.
+
+        Example plugin usage.
+
+        commands = {
+            "on_guild_remove": [
+                <TASK>,
+            ],
+        }
+
+        <TASK> represents a function that is called the event is triggered.
+        <TASK> must have two positional arguments:
+
+            bot: An instance of the bot class.
+            guild: The Guild object that was left.
+        """
+
+        self.role_names.forget(guild)
+
+        for callback in self.plugins.callbacks("on_guild_remove"):
+            await callback(self, guild)
+
+    @metrics.timed_event
+    async def on_member_remove(self, member):
+        """
+        Called when a member leaves or is removed from a guild.
+
+        Example plugin usage.
+
+        commands = {
+            "on_member_remove": [
+                <TASK>,
+            ],
+        }
+
+        <TASK> represents a function that is called the event is triggered.
+        <TASK> must have two positional arguments:
+
+            bot: An instance of the bot class.
+            member: The Member object that left.
+        """
+
+        for callback in self.plugins.callbacks("on_member_remove"):
+            await callback(self, member)
+
+    @metrics.timed_event
     async def on_guild_role_delete(self, role):
         """
         Called when a role is deleted from a guild.
@@ -84,12 +423,12 @@ class HackWeek(discord.AutoShardedClient):
             role: The Role object that was deleted.
         """
 
-        callbacks = self.commands.get("on_guild_role_delete")
+        self.role_names.remove(role)
 
-        if callbacks:
-            for callback in callbacks:
-                await callback(self, role)
+        for callback in self.plugins.callbacks("on_guild_role_delete"):
+            await callback(self, role)
 
+    @metrics.timed_event
     async def on_member_update(self, before, after):
         """
         Called when any of the following properties of a member are changed.
@@ -116,42 +455,100 @@ class HackWeek(discord.AutoShardedClient):
             bot: An instance of the bot class.
             member: The changed member.
             prop: The property before it was changed.
+
+        <TASK> may be a plain function or a coroutine function.
+
+        Properties nobody subscribed to are never compared. Role changes
+        are coalesced per member over `ROLE_UPDATE_WINDOW` seconds, and
+        the tasks get the roles removed over the whole window.
         """
 
         items = self.commands.get("on_member_update")
 
-        if items and type(items) == dict:
-            if before.nick != after.nick:
-                callbacks = items.get("nickname")
-                if callbacks:
-                    for callback in callbacks:
-                        callback(self, after, before.nick)
-            if before.status != after.status:
-                callbacks = items.get("status")
-                if callbacks:
-                    for callback in callbacks:
-                        callback(self, after, before.status)
-            if before.activity != after.activity:
-                callbacks = items.get("activity")
-                if callbacks:
-                    for callback in callbacks:
-                        callback(self, after, before.activity)
-            if before.roles != after.roles:
-                callbacks = items.get("roles")
-                if callbacks:
-                    changed_roles = list(set(before.roles).difference(
-                        set(after.roles)))
-                    for callback in callbacks:
-                        callback(self, after, changed_roles)
-
-
-def create_bot() -> discord.Client:
+        if not items:
+            return
+
+        callbacks = items.get("nickname")
+        if callbacks and before.nick != after.nick:
+            await self._run_callbacks(callbacks, after, before.nick)
+
+        callbacks = items.get("status")
+        if callbacks and before.status != after.status:
+            await self._run_callbacks(callbacks, after, before.status)
+
+        callbacks = items.get("activity")
+        if callbacks and before.activity != after.activity:
+            await self._run_callbacks(callbacks, after, before.activity)
+
+        # Member._roles holds the raw role ids, so comparing them builds
+        # no Role objects.
+        if items.get("roles") and before._roles != after._roles:
+            key = (after.guild.id, after.id)
+            pending = self._pending_roles.get(key)
+
+            if pending:
+                pending[1] = after
+            else:
+                self._pending_roles[key] = [before, after]
+                task = self.loop.create_task(self._flush_roles(key))
+                self._role_flushes.add(task)
+                task.add_done_callback(self._role_flushes.discard)
+
+    async def _flush_roles(self, key: tuple):
+        """
+        Run the role callbacks for one member once their window closes.
+        """
+
+        await asyncio.sleep(self.ROLE_UPDATE_WINDOW)
+        before, after = self._pending_roles.pop(key)
+
+        before_ids = set(before._roles)
+        after_ids = set(after._roles)
+
+        if before_ids == after_ids:
+            return
+
+        changed_roles = [
+            role for role in before.roles if role.id not in after_ids]
+        await self._run_callbacks(
+            self.commands["on_member_update"]["roles"],
+            after,
+            changed_roles)
+
+    async def _run_callbacks(self, callbacks: tuple, *args):
+        """
+        Call each callback with the bot and args, awaiting coroutines.
+        """
+
+        for callback in callbacks:
+            result = callback(self, *args)
+            if inspect.isawaitable(result):
+                await result
+
+
+def create_bot(
+        redis_url: str = "redis://localhost:6379",
+        metrics_port: int = None,
+        **kwargs) -> discord.Client:
     """
     Robot factory. 🤖
 
     No but seriously, this is a factory to create instances of our bot.
+    Extra keyword arguments, such as `metrics_host`, `shard_ids`,
+    `shard_count` and `cluster`, are passed on to the bot.
     """
 
+    start = time.perf_counter()
+    plugins = load_plugins()
+    print(
+        f"Loaded {len(plugins.timings)} plugins in "
+        f"{(time.perf_counter() - start) * 1000:.1f}ms.")
+
     activity = discord.Game("gk help")
-    bot = HackWeek(activity=activity)
+    bot = HackWeek(
+        activity=activity,
+        redis_url=redis_url,
+        plugins=plugins,
+        metrics_port=metrics_port,
+        **kwargs)
     return bot
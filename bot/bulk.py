@@ -0,0 +1,59 @@
+import asyncio
+
+import discord
+
+# How many role edits a bulk command may have in flight at once.
+# discord.py queues requests per rate limit bucket and retries 429s, and
+# every member role edit in a guild shares one bucket, so this only
+# bounds how many requests wait on it.
+CONCURRENCY = 5
+
+
+async def edit_members(
+        users: list,
+        edit,
+        limit: int = CONCURRENCY) -> dict:
+    """
+    Run a Discord edit for each user concurrently.
+
+    Params:
+        users: The users to edit.
+        edit: Coroutine function called with each user.
+        limit: How many edits may run at once.
+
+    Return a dict of the users whose edit failed, mapped to the reason.
+    """
+
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(user):
+        async with semaphore:
+            try:
+                await edit(user)
+            except discord.Forbidden:
+                return user, "missing permissions"
+            except discord.HTTPException as e:
+                return user, e.text or "request failed"
+            return user, None
+
+    results = await asyncio.gather(*[run(user) for user in users])
+    return {user: reason for user, reason in results if reason}
+
+
+def summary(
+        done: str,
+        count: int,
+        failed: dict) -> str:
+    """
+    Format the outcome of a bulk command as one message.
+    """
+
+    lines = [f"{count} {done}"]
+
+    if failed:
+        lines.append("")
+        lines.append("Failed for:")
+        for user, reason in failed.items():
+            lines.append(f"{user.mention} - {reason}")
+
+    return "\n".join(lines)
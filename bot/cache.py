@@ -0,0 +1,107 @@
+import time
+
+from collections import OrderedDict
+
+
+class Cache:
+    """
+    Bounded LRU cache with a time to live, keyed by database key.
+
+    Every invalidation bumps `version`. Readers take the version before
+    going to Redis and pass it to `set`, so a value read before a
+    concurrent invalidation is never cached.
+    """
+
+    MISSING = object()
+
+    def __init__(
+            self,
+            maxsize: int = 10000,
+            ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(
+            self,
+            key: str) -> object:
+        """
+        Return a cached value, or `Cache.MISSING`.
+        """
+
+        entry = self._entries.get(key)
+
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return Cache.MISSING
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(
+            self,
+            key: str,
+            value: object,
+            version: int = None) -> None:
+        """
+        Cache a value, unless the cache was invalidated since `version`.
+        """
+
+        if version is not None and version != self.version:
+            return
+
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(
+            self,
+            *keys: str) -> None:
+        """
+        Drop cached values for the given keys. A key ending in `*`
+        drops every key starting with what precedes it.
+        """
+
+        self.version += 1
+
+        for key in keys:
+            if key.endswith("*"):
+                prefix = key[:-1]
+                for cached in [k for k in self._entries if k.startswith(prefix)]:
+                    del self._entries[cached]
+            else:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Drop every cached value.
+        """
+
+        self.version += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Return hit, miss and size counters for sizing the cache.
+        """
+
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
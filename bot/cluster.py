@@ -0,0 +1,316 @@
+"""
+Run the bot's shards across several processes.
+
+The shard range is split into contiguous clusters, and each cluster runs
+its own `HackWeek` in a worker process against the shared Redis. The
+supervisor restarts workers that exit, backing off while they keep
+failing. Workers report their health to Redis, where `gk status` and
+`python -m bot.cluster status` read it back.
+
+Configured from the environment, like runner.py:
+
+    BOT_TOKEN       bot token
+    REDIS_URL       shared Redis (default redis://localhost:6379)
+    SHARD_COUNT     total shards (default Discord's recommendation)
+    SHARDS          shards run by this launcher, as "first-last"
+                    (default all), so pods can split the range
+    CLUSTERS        worker processes (default one per core)
+    METRICS_PORT    metrics port of the first worker, the others
+                    count up from it
+    METRICS_HOST    address the metrics are served on (default
+                    127.0.0.1, local scrapers only)
+    SWEEPER_PRUNE   "1" to let the sweeper delete the roles of guilds
+                    and Discord roles confirmed gone (default off)
+
+    python -m bot.cluster
+    python -m bot.cluster status
+"""
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import multiprocessing
+
+import discord
+
+from bot import db
+from bot import create_bot
+from bot import HackWeek
+
+# Seconds Discord wants between two shards identifying.
+IDENTIFY_INTERVAL = 5.0
+
+# First restart delay of a failing worker, doubled per quick failure.
+RESTART_DELAY = 5.0
+MAX_RESTART_DELAY = 300.0
+
+# A worker that ran this long before exiting is restarted right away.
+STABLE_AFTER = 300.0
+
+# A cluster silent for this long is reported as down.
+STALE_AFTER = 3 * HackWeek.HEARTBEAT_INTERVAL
+
+
+def split_shards(
+        shard_ids: list,
+        clusters: int) -> list:
+    """
+    Split shard ids into at most `clusters` contiguous, even chunks.
+    """
+
+    clusters = max(1, min(clusters, len(shard_ids)))
+    size, extra = divmod(len(shard_ids), clusters)
+    chunks = []
+    start = 0
+
+    for index in range(clusters):
+        end = start + size + (index < extra)
+        chunks.append(shard_ids[start:end])
+        start = end
+
+    return chunks
+
+
+async def recommended_shards(token: str) -> int:
+    """
+    Ask Discord how many shards the bot should run.
+    """
+
+    http = discord.http.HTTPClient()
+
+    try:
+        await http.static_login(token, bot=True)
+        shards, _ = await http.get_bot_gateway()
+    finally:
+        await http.close()
+
+    return shards
+
+
+def run_worker(
+        cluster: int,
+        shard_ids: list,
+        shard_count: int,
+        token: str,
+        redis_url: str,
+        metrics_port: int = None,
+        metrics_host: str = "127.0.0.1",
+        prune_stale: bool = False) -> None:
+    """
+    Run one cluster's shards until the bot stops. Worker process target.
+    """
+
+    bot = create_bot(
+        redis_url=redis_url,
+        metrics_port=metrics_port,
+        metrics_host=metrics_host,
+        shard_ids=shard_ids,
+        shard_count=shard_count,
+        cluster=cluster,
+        prune_stale=prune_stale)
+    bot.run(token)
+
+
+class Supervisor:
+    """
+    Keeps one worker process running per cluster.
+
+    First starts are staggered so that clusters do not identify their
+    shards at the same time. A worker that exits is restarted after
+    `RESTART_DELAY`, doubled for every exit within `STABLE_AFTER` seconds
+    of starting, up to `MAX_RESTART_DELAY`.
+    """
+
+    def __init__(
+            self,
+            token: str,
+            shard_count: int,
+            clusters: list,
+            redis_url: str,
+            metrics_port: int = None,
+            metrics_host: str = "127.0.0.1",
+            prune_stale: bool = False):
+        self.token = token
+        self.shard_count = shard_count
+        self.clusters = clusters
+        self.redis_url = redis_url
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.prune_stale = prune_stale
+        self.processes = {}
+        self.failures = [0] * len(clusters)
+        self._context = multiprocessing.get_context("spawn")
+        self._started = [0.0] * len(clusters)
+        self._start_at = [0.0] * len(clusters)
+        self._stopping = False
+
+    def _spawn(
+            self,
+            index: int) -> None:
+        shard_ids = self.clusters[index]
+        process = self._context.Process(
+            target=run_worker,
+            args=(
+                shard_ids[0],
+                shard_ids,
+                self.shard_count,
+                self.token,
+                self.redis_url,
+                self.metrics_port + index if self.metrics_port else None,
+                self.metrics_host,
+                self.prune_stale),
+            name=f"cluster-{shard_ids[0]}")
+        process.start()
+
+        self.processes[index] = process
+        self._started[index] = time.monotonic()
+        print(f"Started cluster {shard_ids[0]} (pid {process.pid}).")
+
+    def _reap(
+            self,
+            index: int,
+            now: float) -> None:
+        process = self.processes.pop(index)
+
+        if now - self._started[index] > STABLE_AFTER:
+            self.failures[index] = 0
+        delay = min(
+            MAX_RESTART_DELAY,
+            RESTART_DELAY * 2 ** self.failures[index])
+        self.failures[index] += 1
+        self._start_at[index] = now + delay
+
+        print(
+            f"Cluster {self.clusters[index][0]} exited with code "
+            f"{process.exitcode}, restarting in {delay:.0f}s.")
+
+    def stop(self, *args) -> None:
+        self._stopping = True
+
+    def run(self) -> None:
+        """
+        Supervise the workers until SIGINT or SIGTERM, then stop them.
+        """
+
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        start_at = time.monotonic()
+        for index, shard_ids in enumerate(self.clusters):
+            self._start_at[index] = start_at
+            start_at += len(shard_ids) * IDENTIFY_INTERVAL
+
+        while not self._stopping:
+            now = time.monotonic()
+
+            for index in range(len(self.clusters)):
+                process = self.processes.get(index)
+
+                if process is not None:
+                    if not process.is_alive():
+                        self._reap(index, now)
+                elif now >= self._start_at[index]:
+                    self._spawn(index)
+
+            time.sleep(1)
+
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(30)
+            if process.is_alive():
+                process.kill()
+
+
+def _shard_range(shard_ids: list or None) -> str:
+    if not shard_ids:
+        return "all"
+    if shard_ids == list(range(shard_ids[0], shard_ids[-1] + 1)):
+        return f"{shard_ids[0]}-{shard_ids[-1]}"
+    return ", ".join(str(shard) for shard in shard_ids)
+
+
+def format_status(
+        reports: dict,
+        now: float) -> str:
+    """
+    Format the health reports of every cluster as one message.
+    """
+
+    if not reports:
+        return "No clusters have reported in."
+
+    lines = []
+    guilds = 0
+
+    for cluster, health in sorted(reports.items()):
+        age = now - health["updated"]
+
+        if age > STALE_AFTER:
+            state = f"down, last seen {age:.0f}s ago"
+        elif health["ready"]:
+            state = "ready"
+            guilds += health["guilds"]
+        else:
+            state = "connecting"
+
+        latency = health["latency"]
+        latency = f"{latency * 1000:.0f}ms" if latency is not None else "-"
+
+        lines.append(
+            f"Cluster {cluster}: {state} | "
+            f"shards {_shard_range(health['shards'])} | "
+            f"{health['guilds']} guilds | {latency} | pid {health['pid']}")
+
+    lines.append("")
+    lines.append(f"{len(reports)} clusters, {guilds} guilds ready.")
+    return "\n".join(lines)
+
+
+async def _status(redis_url: str) -> str:
+    db.connect(redis_url)
+    try:
+        return format_status(await db.cluster_health(), time.time())
+    finally:
+        await db.disconnect()
+
+
+def main(argv: list) -> None:
+    redis_url = os.environ.get("REDIS_URL", "redis://localhost:6379")
+
+    if argv[1:2] == ["status"]:
+        print(asyncio.run(_status(redis_url)))
+        return
+
+    token = os.environ.get("BOT_TOKEN")
+
+    if not token:
+        raise EnvironmentError
+
+    shard_count = os.environ.get("SHARD_COUNT")
+    shard_count = int(shard_count) if shard_count else \
+        asyncio.run(recommended_shards(token))
+
+    first, _, last = os.environ.get("SHARDS", f"0-{shard_count - 1}") \
+        .partition("-")
+    shard_ids = list(range(int(first), int(last or first) + 1))
+
+    clusters = int(os.environ.get("CLUSTERS") or os.cpu_count() or 1)
+    metrics_port = os.environ.get("METRICS_PORT")
+    metrics_host = os.environ.get("METRICS_HOST", "127.0.0.1")
+    prune_stale = os.environ.get("SWEEPER_PRUNE") == "1"
+
+    Supervisor(
+        token,
+        shard_count,
+        split_shards(shard_ids, clusters),
+        redis_url,
+        int(metrics_port) if metrics_port else None,
+        metrics_host,
+        prune_stale).run()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
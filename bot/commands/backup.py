@@ -0,0 +1,129 @@
+import tempfile
+
+import discord
+
+from bot.db import Role
+from bot.transfer import export_guild
+from bot.transfer import import_guild
+from bot.transfer import open_backup
+from bot.transfer import read_roles
+
+
+async def export_roles(bot, message):
+    """
+    Export every GK role of the guild as a file.
+
+    Example usage:
+
+        gk export
+    """
+
+    if not message.author.guild_permissions.manage_roles:
+        await message.channel.send(
+            "You are not authorized to perform this action.")
+        return
+
+    filename = f"gk-roles-{message.guild.id}.jsonl.gz"
+
+    with tempfile.TemporaryFile() as raw:
+        with open_backup(raw, "w", name=filename) as out:
+            counts = await export_guild(message.guild.id, out)
+        raw.seek(0)
+
+        await message.channel.send(
+            f"Exported {counts['roles']} roles, {counts['permsets']} "
+            f"permsets and {counts['members']} members.",
+            file=discord.File(raw, filename=filename))
+
+
+async def import_roles(bot, message):
+    """
+    Restore GK roles from an attached export, replacing the roles it holds.
+
+    Example usage:
+
+        gk import (with the export attached)
+    """
+
+    if not message.author.guild_permissions.manage_roles:
+        await message.channel.send(
+            "You are not authorized to perform this action.")
+        return
+
+    if not message.attachments:
+        await message.channel.send(
+            "Invalid command.\n\n`gk import` with an export attached.")
+        return
+
+    attachment = message.attachments[0]
+
+    with tempfile.TemporaryFile() as raw:
+        await attachment.save(raw)
+        raw.seek(0)
+
+        try:
+            with open_backup(raw, name=attachment.filename) as lines:
+                role_ids = read_roles(lines, message.guild.id)
+
+                refusal = await _check_roles(message, role_ids)
+                if refusal:
+                    await message.channel.send(refusal)
+                    return
+
+                lines.seek(0)
+                counts = await import_guild(lines, message.guild.id)
+        except (ValueError, OSError) as error:
+            await message.channel.send(
+                "That file is not a GK role export of this server.\n\n"
+                f"{error}")
+            return
+
+    await message.channel.send(
+        f"Imported {counts['roles']} roles, {counts['permsets']} "
+        f"permsets and {counts['members']} members.")
+
+
+async def _check_roles(message, role_ids):
+    """
+    Return why the author may not import the given roles, or None.
+
+    Only GK roles of the guild below the author's top role may be
+    replaced, so that an export cannot make GK hand out other roles.
+    """
+
+    owner = message.author.id == message.guild.owner_id
+
+    for role_id in role_ids:
+        role = message.guild.get_role(role_id)
+
+        if role is None:
+            return f"Role `{role_id}` is not in this server."
+        if not owner and role >= message.author.top_role:
+            return (
+                f"Role **\"{role.name}\"** is not below your top role, so "
+                "you may not import it.")
+        if not await Role.get(role):
+            return (
+                f"Role **\"{role.name}\"** is not a GK role. Create it with "
+                "`gk create role named <name>` first.")
+
+    return None
+
+
+commands = {
+    "on_message": {
+        "gk export": export_roles,
+        "gk import": import_roles,
+    },
+}
+
+rate_limits = {
+    "gk export": {
+        "user": (1, 300.0),
+        "guild": (1, 300.0),
+    },
+    "gk import": {
+        "user": (1, 300.0),
+        "guild": (1, 300.0),
+    },
+}
@@ -1,8 +1,10 @@
 import re
 
-from discord.utils import find
-
+from bot.bulk import edit_members
+from bot.bulk import summary
 from bot.db import Role
+from bot.db import flush
+from bot.db import prefetch
 from bot.utils import Permission
 
 
@@ -18,34 +20,43 @@ async def invite_users(bot, message):
             "Invalid command.\n\n`gk invite <user mention> [<user_mention>, ...] to <role>`")
         return
 
-    role = find(
-        lambda r: r.name.lower() == match.group(1).lower(),
-        message.guild.roles)
+    role = bot.role_names.find(message.guild, match.group(1))
 
     if not role:
         await message.channel.send(
             f"No role named **\"{match.group(1)}\"** was found.")
         return
 
-    role_entry = Role.get(role)
+    await prefetch(role, message.author)
+
+    role_entry = await Role.get(role)
 
     if not role_entry:
         await message.channel.send(
             f"Role named **\"{match.group(1)}\"** is a simple role.")
         return
 
-    if not role_entry.check_member_for_perm(
+    if not await role_entry.check_member_for_perm(
             message.author,
-            Permission.INVITE_USERS()):
+            Permission.INVITE_USERS):
         await message.channel.send(
             "You are not authorized to perform this action.")
         return
 
-    for user in message.mentions:
-        role_entry.add_member(user, "default")
-        await user.add_roles(role)
+    added = await role_entry.add_members(message.mentions, "default")
+    failed = {
+        user: "already a member"
+        for user in message.mentions if user not in added}
+
+    errors = await edit_members(added, lambda user: user.add_roles(role))
+    if errors:
+        await role_entry.remove_members(list(errors))
+    failed.update(errors)
 
-    await message.channel.send(f"{len(message.mentions)} were added to **\"{match.group(1)}\"**")
+    await message.channel.send(summary(
+        f"were added to **\"{match.group(1)}\"**",
+        len(added) - len(errors),
+        failed))
 
 
 async def leave_role(bot, message):
@@ -60,23 +71,24 @@ async def leave_role(bot, message):
             "Invalid command.\n\n`gk leave <role>`")
         return
 
-    role = find(
-        lambda r: r.name.lower() == match.group(1).lower(),
-        message.guild.roles)
+    role = bot.role_names.find(message.guild, match.group(1))
 
     if not role:
         await message.channel.send(
             f"No role named **\"{match.group(1)}\"** was found.")
         return
 
-    role_entry = Role.get(role)
+    await prefetch(role)
+
+    role_entry = await Role.get(role)
 
     if not role_entry:
         await message.channel.send(
             f"Role named **\"{match.group(1)}\"** is a simple role.")
         return
 
-    role_entry.remove_member(message.author)
+    await role_entry.remove_member(message.author)
+    await flush()
     await message.author.remove_roles(role)
 
     await message.channel.send(f"Successfully left **\"{match.group(1)}\"**")
@@ -94,34 +106,47 @@ async def kick_users(bot, message):
             "Invalid command.\n\n`gk kick <user mention> [<user_mention>, ...] from <role>`")
         return
 
-    role = find(
-        lambda r: r.name.lower() == match.group(1).lower(),
-        message.guild.roles)
+    role = bot.role_names.find(message.guild, match.group(1))
 
     if not role:
         await message.channel.send(
             f"No role named **\"{match.group(1)}\"** was found.")
         return
 
-    role_entry = Role.get(role)
+    await prefetch(role, message.author)
+
+    role_entry = await Role.get(role)
 
     if not role_entry:
         await message.channel.send(
             f"Role named **\"{match.group(1)}\"** is a simple role.")
         return
 
-    if not role_entry.check_member_for_perm(
+    if not await role_entry.check_member_for_perm(
             message.author,
-            Permission.REMOVE_USERS()):
+            Permission.REMOVE_USERS):
         await message.channel.send(
             "You are not authorized to perform this action.")
         return
 
-    for user in message.mentions:
-        role_entry.remove_member(user)
-        await user.remove_roles(role)
+    failed = await edit_members(
+        message.mentions,
+        lambda user: user.remove_roles(role))
+    await role_entry.remove_members(
+        [user for user in message.mentions if user not in failed])
+
+    await message.channel.send(summary(
+        f"were removed from **\"{match.group(1)}\"**",
+        len(message.mentions) - len(failed),
+        failed))
+
+
+async def forget_member(bot, member):
+    """
+    Remove a member who left the guild from every GK role.
+    """
 
-    await message.channel.send(f"{len(message.mentions)} were removed from **\"{match.group(1)}\"**")
+    await Role.purge_member(member.guild.id, member.id)
 
 
 commands = {
@@ -129,5 +154,8 @@ commands = {
         "gk invite": invite_users,
         "gk leave": leave_role,
         "gk kick": kick_users,
-    }
+    },
+    "on_member_remove": [
+        forget_member,
+    ],
 }
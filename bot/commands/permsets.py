@@ -1,7 +1,9 @@
-from discord.utils import find
-
+from bot.bulk import summary
 from bot.db import Permset
 from bot.db import Role
+from bot.db import flush
+from bot.db import prefetch
+from bot.db import refresh
 
 from bot.utils import Permission
 from bot.utils import find_match
@@ -24,9 +26,7 @@ async def list_permsets_for(bot, message):
             "Invalid command.\n\n`gk list permsets for <role>`.")
         return
 
-    role = find(
-        lambda r: r.name.lower() == match.group(1).lower(),
-        message.guild.roles)
+    role = bot.role_names.find(message.guild, match.group(1))
 
     if not role:
         await message.channel.send(
@@ -34,7 +34,9 @@ async def list_permsets_for(bot, message):
             f"Consider creating one? `gk create role named {match.group(1)}`.")
         return
 
-    permset_names = [str(p) for p in Permset.get_all(role)]
+    await prefetch(role)
+
+    permset_names = [str(p) for p in await Permset.get_all(role)]
     permsets = "\n".join(permset_names)
 
     await message.channel.send(
@@ -57,9 +59,7 @@ async def create_permset_named(bot, message):
             "Invalid command.\n\n`gk create permset named <name> for <role> `.")
         return
 
-    role = find(
-        lambda r: r.name.lower() == match.group(2).lower(),
-        message.guild.roles)
+    role = bot.role_names.find(message.guild, match.group(2))
 
     if not role:
         await message.channel.send(
@@ -67,37 +67,43 @@ async def create_permset_named(bot, message):
             f"Consider creating one? `gk create role named {match.group(2)}`.")
         return
 
-    role_entry = Role.get(role)
+    await prefetch(role, message.author)
+
+    role_entry = await Role.get(role)
 
     if not role_entry:
         await message.channel.send(
             f"Role named **\"{match.group(1)}\"** is a simple role.")
         return
 
-    if not role_entry.check_member_for_perm(
+    if not await role_entry.check_member_for_perm(
             message.author,
-            Permission.MANAGE_PERMSETS()):
+            Permission.MANAGE_PERMSETS):
         await message.channel.send(
             "You are not authorized to perform this action.")
         return
 
     name = clean(match.group(1))
 
-    if Permset.exists(name, role=role):
+    if await Permset.exists(name, role=role):
         await message.channel.send(
             f"Permset named **\"{name}\"** already exists.")
         return
 
-    permset = Permset.create(role, name, Permission.default())
+    permset = await Permset.create(role, name, Permission.default())
 
     permissions = await Permission.select_permissions(
         bot,
         message.author,
-        Permset.for_user(role, message.author).giveable,
+        (await Permset.for_user(role, message.author)).giveable,
         destination=message.channel)
 
     if permissions:
-        permset.update(permissions=permissions)
+        permset, giveable = await _reread(message, role, name)
+        if not permset:
+            return
+        await permset.update(permissions=permissions & giveable)
+        await flush()
 
     await message.channel.send(f"Permset named **\"{name}\"** was created!")
 
@@ -118,9 +124,7 @@ async def update_permset_named(bot, message):
             "Invalid command.\n\n`gk update permset named <name> for <role> `")
         return
 
-    role = find(
-        lambda r: r.name.lower() == match.group(2).lower(),
-        message.guild.roles)
+    role = bot.role_names.find(message.guild, match.group(2))
 
     if not role:
         await message.channel.send(
@@ -128,24 +132,26 @@ async def update_permset_named(bot, message):
             f"Consider creating one? `gk create role named {match.group(2)}`.")
         return
 
+    await prefetch(role, message.author)
+
     name = clean(match.group(1))
-    permset = Permset.get(role, name)
+    permset = await Permset.get(role, name)
 
     if not permset:
         await message.channel.send(
             f"No permset named **\"{name}\"** was found")
         return
 
-    role_entry = Role.get(role)
+    role_entry = await Role.get(role)
 
     if not role_entry:
         await message.channel.send(
             f"Role named **\"{match.group(1)}\"** is a simple role.")
         return
 
-    if not role_entry.check_member_for_perm(
+    if not await role_entry.check_member_for_perm(
             message.author,
-            Permission.MANAGE_PERMSETS()):
+            Permission.MANAGE_PERMSETS):
         await message.channel.send(
             "You are not authorized to perform this action.")
         return
@@ -153,14 +159,48 @@ async def update_permset_named(bot, message):
     permissions = await Permission.select_permissions(
         bot,
         message.author,
-        Permset.for_user(role, message.author).giveable,
+        (await Permset.for_user(role, message.author)).giveable,
         destination=message.channel)
 
     if permissions:
-        permset.update(permissions=permissions)
+        permset, giveable = await _reread(message, role, name)
+        if not permset:
+            return
+        await permset.update(permissions=permissions & giveable)
+        await flush()
         await message.channel.send(f"Permset named **\"{name}\"** was updated!")
 
 
+async def _reread(message, role, name):
+    """
+    Read a permset and the author's permset again once the author has
+    picked permissions, as the guild's other commands ran meanwhile.
+
+    Reply and return (None, None) if the permset is gone or the author
+    may no longer manage permsets, else return the permset and the
+    permissions the author may give.
+    """
+
+    refresh()
+    permset = await Permset.get(role, name)
+
+    if not permset:
+        await message.channel.send(
+            f"Permset named **\"{name}\"** was deleted meanwhile.")
+        return None, None
+
+    author_permset = await Permset.for_user(role, message.author)
+    giveable = author_permset and author_permset.giveable
+
+    if giveable is None or \
+            not author_permset.has_permission(Permission.MANAGE_PERMSETS):
+        await message.channel.send(
+            "You are not authorized to perform this action.")
+        return None, None
+
+    return permset, giveable
+
+
 async def delete_permset_named(bot, message):
     """
     Delete a permset for a role.
@@ -177,38 +217,38 @@ async def delete_permset_named(bot, message):
             "Invalid command.\n\n`gk delete permset named <name> for <role> `")
         return
 
-    role = find(
-        lambda r: r.name.lower() == match.group(2).lower(),
-        message.guild.roles)
+    role = bot.role_names.find(message.guild, match.group(2))
 
     if not role:
         await message.channel.send(
             f"No role named **\"{match.group(2)}\"** was found.")
         return
 
+    await prefetch(role, message.author)
+
     name = clean(match.group(1))
-    permset = Permset.get(role, name)
+    permset = await Permset.get(role, name)
 
     if not permset:
         await message.channel.send(
             f"No permset named **\"{name}\"** was found.")
         return
 
-    role_entry = Role.get(role)
+    role_entry = await Role.get(role)
 
     if not role_entry:
         await message.channel.send(
             f"Role named **\"{match.group(1)}\"** is a simple role.")
         return
 
-    if not role_entry.check_member_for_perm(
+    if not await role_entry.check_member_for_perm(
             message.author,
-            Permission.MANAGE_PERMSETS()):
+            Permission.MANAGE_PERMSETS):
         await message.channel.send(
             "You are not authorized to perform this action.")
         return
 
-    permset.delete()
+    await permset.delete()
     await message.channel.send(f"Permset named **\"{name}\"** was deleted!")
 
 
@@ -228,9 +268,7 @@ async def grant_permset_to(bot, message):
             "Invalid command.\n\n`gk create permset named <name> for <role> `")
         return
 
-    role = find(
-        lambda r: r.name.lower() == match.group(2).lower(),
-        message.guild.roles)
+    role = bot.role_names.find(message.guild, match.group(2))
 
     if not role:
         await message.channel.send(
@@ -238,33 +276,39 @@ async def grant_permset_to(bot, message):
             f"Consider creating one? `gk create role named {match.group(2)}`.")
         return
 
-    role_entry = Role.get(role)
+    await prefetch(role, message.author)
+
+    role_entry = await Role.get(role)
 
     if not role_entry:
         await message.channel.send(
             f"Role named **\"{match.group(1)}\"** is a simple role.")
         return
 
-    if not role_entry.check_member_for_perm(
+    if not await role_entry.check_member_for_perm(
             message.author,
-            Permission.MANAGE_USERS()):
+            Permission.MANAGE_USERS):
         await message.channel.send(
             "You are not authorized to perform this action.")
         return
 
     name = clean(match.group(1))
-    permset = Permset.get(role, name)
+    permset = await Permset.get(role, name)
 
     if not permset:
         await message.channel.send(
             f"No permset named **\"{name}\"** was found")
         return
 
-    for user in message.mentions:
-        permset.add_member(user)
+    moved = await permset.add_members(message.mentions)
+    failed = {
+        user: f"not a member of **\"{match.group(2)}\"**"
+        for user in message.mentions if user not in moved}
 
-    await message.channel.send(
-        f"Permset named **\"{name}\"** given to {len(message.mentions)} users!")
+    await message.channel.send(summary(
+        f"were given permset **\"{name}\"**",
+        len(moved),
+        failed))
 
 
 commands = {
@@ -276,3 +320,10 @@ commands = {
         "gk grant permset named": grant_permset_to,
     },
 }
+
+rate_limits = {
+    "gk list permsets": {
+        "user": (3, 10.0),
+        "guild": (10, 10.0),
+    },
+}
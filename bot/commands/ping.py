@@ -35,6 +35,9 @@ Any time you see `<> [<>, ...]` in a command, it means you can provide one or mo
 `gk list permsets for <gk role>`
 *Lists all permsets of a gk role.*
 
+`gk status`
+*Shows the health of every bot cluster and any schema migration.*
+
 **Admin Commands**
 *You must have extended permissions to use these*
 
@@ -44,6 +47,12 @@ Any time you see `<> [<>, ...]` in a command, it means you can provide one or mo
 `gk delete role named <gk role>`
 *Delete a gk role of the specified name.*
 
+`gk export`
+*Export every gk role of the server as a file.*
+
+`gk import`
+*Restore the gk roles in an attached export, replacing their current setup.*
+
 `gk create permset named <permset> for <gk role>`
 *Create a permset for a gk role.*
 
@@ -66,3 +75,10 @@ commands = {
         "gk help": help_them,
     },
 }
+
+# Help is two DMs, so one per user a minute is plenty.
+rate_limits = {
+    "gk help": {
+        "user": (1, 60.0),
+    },
+}
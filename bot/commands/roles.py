@@ -3,7 +3,6 @@ import random
 
 from discord import Colour
 from discord.utils import escape_mentions
-from discord.utils import find
 
 from bot.db import Role
 
@@ -25,9 +24,7 @@ async def create_role_named(bot, message):
 
     name = match.group(1)
 
-    if find(
-            lambda r: r.name.lower() == name.lower(),
-            message.guild.roles):
+    if bot.role_names.find(message.guild, name):
         await message.channel.send(
             f"Role name **\"{name}\"** is taken.")
         return
@@ -45,7 +42,7 @@ async def create_role_named(bot, message):
         colour=colour,
         reason="Created for user with complex perms.")
 
-    if Role.create(role, message.author):
+    if await Role.create(role, message.author):
         await message.author.add_roles(role)
         await message.channel.send(f"Role named **\"{name}\"** was created!")
         return
@@ -68,9 +65,7 @@ async def delete_role_named(bot, message):
 
     name = match.group(1)
 
-    role = find(
-        lambda r: r.name.lower() == name.lower(),
-        message.guild.roles)
+    role = bot.role_names.find(message.guild, name)
 
     if not role:
         await message.channel.send(
@@ -82,7 +77,9 @@ async def delete_role_named(bot, message):
             "You are not authorized to perform this action.")
         return
 
-    Role.get(role).delete()
+    role_entry = await Role.get(role)
+    if role_entry:
+        await role_entry.delete()
     await role.delete()
 
     await message.channel.send(f"Role named **\"{name}\"** was deleted!")
@@ -94,9 +91,18 @@ async def delete_role(bot, role):
     removed.
     """
 
-    role_entry = Role.get(role)
+    role_entry = await Role.get(role)
     if role_entry:
-        role_entry.delete()
+        await role_entry.delete()
+
+
+async def forget_guild(bot, guild):
+    """
+    Delete every GK role of a guild the bot was removed from, in the
+    background.
+    """
+
+    bot.loop.create_task(Role.purge_guild(guild.id))
 
 
 commands = {
@@ -106,5 +112,8 @@ commands = {
     },
     "on_guild_role_delete": [
         delete_role,
-    ]
+    ],
+    "on_guild_remove": [
+        forget_guild,
+    ],
 }
@@ -0,0 +1,36 @@
+import time
+
+from bot.cluster import format_status
+from bot.db import cluster_health
+from bot.migrations import format_progress
+from bot.migrations import schema_state
+
+
+async def cluster_status(bot, message):
+    """
+    Report the health of every cluster running the bot, and the
+    progress of any running schema migration, to members who can manage
+    the server.
+
+    Example usage:
+
+        gk status
+    """
+
+    if not message.author.guild_permissions.manage_guild:
+        await message.channel.send(
+            "You are not authorized to perform this action.")
+        return
+
+    now = time.time()
+
+    await message.channel.send(
+        format_status(await cluster_health(), now) + "\n" +
+        format_progress(await schema_state(), now))
+
+
+commands = {
+    "on_message": {
+        "gk status": cluster_status,
+    },
+}
@@ -1,19 +1,542 @@
 import re
+import json
+import time
+import asyncio
+import contextvars
+
+from contextlib import asynccontextmanager
+
+# aioredis 2 is redis-py's asyncio client under its old name. redis-py
+# itself needs async-timeout>=4.0.2, which the aiohttp<3.6 pinned by
+# discord.py 1.2.2 rules out.
+from aioredis import ConnectionPool
+from aioredis import Redis
+from aioredis import RedisError
+from aioredis.client import Pipeline
+
+from bot.cache import Cache
+from bot.metrics import REDIS_SECONDS
+from bot.scripts import SCRIPTS
+from bot.utils import Permission
 
-from redis import Redis
+# Channel every bot process publishes changed keys to.
+INVALIDATION_CHANNEL = "gk:invalidate"
 
-from bot.utils import Permission
+# Hash of cluster id to the latest health report of that cluster.
+CLUSTERS_KEY = "gk:clusters"
+
+# Member buckets read per script call.
+BUCKET_BATCH = 64
+
+# List of the member buckets of deleted roles, whose members' user role
+# indexes are still to be cleaned.
+DELETED_KEY = "gk:deleted"
+
+# Roles, permsets and member lookups read by this process.
+cache = Cache()
+
+# While a migration that can move single roles is running, a coroutine
+# function moving a role into the new layout. Set by `bot.migrations`.
+_role_migration = None
+
+# Roles this process has moved during the running migration.
+_migrated_roles = set()
+
+# Whether every member is listed in its user role index. Cleared by
+# `bot.migrations` until the indexes are built.
+_user_index = True
+
+# The unit of work of the command the current task runs, if any.
+_unit = contextvars.ContextVar("unit_of_work", default=None)
+
+
+class InstrumentedRedis(Redis):
+    """
+    Redis client recording the round trip time of every command.
+    """
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_SECONDS.observe(
+                time.perf_counter() - start,
+                str(args[0]).upper())
+
+    def pipeline(
+            self,
+            transaction: bool = True,
+            shard_hint: str = None) -> Pipeline:
+        return InstrumentedPipeline(
+            self.connection_pool,
+            self.response_callbacks,
+            transaction,
+            shard_hint)
+
+
+class InstrumentedPipeline(Pipeline):
+    """
+    Pipeline recording the round trip time of each batch it sends.
+    """
+
+    async def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(*args, **kwargs)
+        finally:
+            REDIS_SECONDS.observe(
+                time.perf_counter() - start,
+                "MULTI" if self.is_transaction else "PIPELINE")
 
 
 class db_connection:
-    def __enter__(self):
-        db = Redis()
-        return db
+    """
+    Hand out the bot's shared asyncio Redis client.
+
+    The client is created once by `connect` and every `async with`
+    block borrows a connection from its pool for each command.
+    """
+
+    client = None
+    scripts = {}
+
+    async def __aenter__(self):
+        if db_connection.client is None:
+            raise RuntimeError(
+                "No Redis client, call bot.db.connect first.")
+        return db_connection.client
 
-    def __exit__(self, type, value, traceback):
+    async def __aexit__(self, type, value, traceback):
         pass
 
 
+def connect(
+        url: str = "redis://localhost:6379",
+        max_connections: int = 32) -> Redis:
+    """
+    Create the pooled Redis client shared by all database entries.
+    """
+
+    pool = ConnectionPool.from_url(url, max_connections=max_connections)
+    return use_client(InstrumentedRedis(connection_pool=pool))
+
+
+def use_client(client: Redis) -> Redis:
+    """
+    Share an existing Redis client, such as a stand-in for benchmarks,
+    and register the Lua scripts on it.
+    """
+
+    db_connection.client = client
+    db_connection.scripts = {
+        name: client.register_script(source)
+        for name, source in SCRIPTS.items()}
+    return client
+
+
+async def load_scripts() -> None:
+    """
+    Load every registered Lua script into Redis' script cache.
+    """
+
+    async with db_connection() as db:
+        for script in db_connection.scripts.values():
+            script.sha = await db.script_load(script.script)
+
+
+async def disconnect() -> None:
+    """
+    Close every connection held by the shared client's pool.
+    """
+
+    client = db_connection.client
+    db_connection.client = None
+
+    if client:
+        await client.connection_pool.disconnect()
+
+
+async def listen_for_invalidations() -> None:
+    """
+    Evict keys from the cache as any bot process publishes changes.
+
+    Runs until cancelled. The cache is cleared whenever the subscription
+    is (re)established, since changes may have been missed meanwhile.
+    """
+
+    while True:
+        try:
+            async with db_connection() as db:
+                pubsub = db.pubsub()
+                try:
+                    await pubsub.subscribe(INVALIDATION_CHANNEL)
+                    cache.clear()
+
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            cache.invalidate(
+                                *message["data"].decode().split("\n"))
+                finally:
+                    # Hand the subscription's connection back to the
+                    # pool, or every reconnect would hold on to one.
+                    await pubsub.reset()
+        except (RedisError, OSError):
+            cache.clear()
+            await asyncio.sleep(1)
+
+
+async def report_health(
+        cluster: int,
+        health: dict) -> None:
+    """
+    Record a cluster's latest health report.
+    """
+
+    async with db_connection() as db:
+        await db.hset(CLUSTERS_KEY, cluster, json.dumps(health))
+
+
+async def forget_cluster(
+        cluster: int) -> None:
+    """
+    Drop the health report of a cluster shutting down cleanly.
+    """
+
+    async with db_connection() as db:
+        await db.hdel(CLUSTERS_KEY, cluster)
+
+
+async def cluster_health() -> dict:
+    """
+    Return the latest health report of every cluster, by cluster id.
+    """
+
+    async with db_connection() as db:
+        reports = await db.hgetall(CLUSTERS_KEY)
+
+    return {
+        int(cluster): json.loads(health)
+        for cluster, health in reports.items()}
+
+
+def use_role_migration(migrate: object) -> None:
+    """
+    Move every role with `migrate` the first time this process reads it,
+    until called again with None.
+
+    Lets a migration run in the background without readers seeing roles
+    in the old layout: a role is moved in full before any read or write
+    touches it, so writes only ever land in the new layout.
+    """
+
+    global _role_migration
+
+    if migrate is not _role_migration:
+        _role_migration = migrate
+        _migrated_roles.clear()
+
+
+async def _migrate_role(
+        role_key: str) -> None:
+    """
+    Move a role into the new layout if a migration is running and this
+    process has not moved it yet.
+    """
+
+    migrate = _role_migration
+
+    if migrate is None or role_key in _migrated_roles:
+        return
+
+    await migrate(role_key)
+    _migrated_roles.add(role_key)
+
+
+def use_user_index(
+        complete: bool) -> None:
+    """
+    Purge members through their user role indexes, or while these are
+    incomplete, through every role of their guild.
+    """
+
+    global _user_index
+    _user_index = complete
+
+
+def _invalidate(
+        client: object,
+        *keys: str) -> object:
+    """
+    Evict keys from this process' cache and publish them to the others.
+
+    Return the publish call, so it can be awaited or queued on a pipeline.
+    """
+
+    cache.invalidate(*keys)
+
+    unit = _unit.get()
+    if unit is not None:
+        unit.forget(*keys)
+
+    return client.publish(INVALIDATION_CHANNEL, "\n".join(keys))
+
+
+def _recall(
+        key: str) -> object:
+    """
+    Return a value read earlier in the current unit of work, or cached,
+    or `Cache.MISSING`.
+    """
+
+    unit = _unit.get()
+
+    if unit is not None and key in unit.reads:
+        return unit.reads[key]
+
+    value = cache.get(key)
+    if unit is not None and value is not Cache.MISSING:
+        unit.reads[key] = value
+    return value
+
+
+def _remember(
+        key: str,
+        value: object,
+        version: int) -> None:
+    """
+    Keep a value read from Redis for the current unit of work, and cache
+    it unless the cache was invalidated since `version`.
+    """
+
+    unit = _unit.get()
+
+    if unit is not None:
+        unit.reads[key] = value
+    cache.set(key, value, version)
+
+
+class UnitOfWork:
+    """
+    The reads and writes of one command.
+
+    Reads made through the data layer are kept for the rest of the
+    command, so it hits Redis at most once per key and its checks agree
+    with each other, and `prefetch` fetches the ones a handler knows it
+    needs in a single round trip. Writes whose results are not needed
+    are queued on one transaction, dropped if the command fails. They are
+    flushed when the command ends, or earlier with `flush`, which
+    handlers call before replying or changing anything on Discord.
+    """
+
+    def __init__(self):
+        self.reads = {}
+        self._writes = None
+
+    def writes(self) -> Pipeline:
+        """
+        Return the transaction writes are queued on.
+        """
+
+        if self._writes is None:
+            self._writes = db_connection.client.pipeline(transaction=True)
+        return self._writes
+
+    def forget(
+            self,
+            *keys: str) -> None:
+        """
+        Drop kept reads, with the same patterns as `Cache.invalidate`.
+        """
+
+        for key in keys:
+            if key.endswith("*"):
+                prefix = key[:-1]
+                for read in [k for k in self.reads if k.startswith(prefix)]:
+                    del self.reads[read]
+            else:
+                self.reads.pop(key, None)
+
+    async def flush(self) -> None:
+        """
+        Run the queued writes as one MULTI/EXEC.
+        """
+
+        writes, self._writes = self._writes, None
+
+        if writes is not None and len(writes):
+            await writes.execute()
+
+
+@asynccontextmanager
+async def unit_of_work():
+    """
+    Run the block as one unit of work, flushing its writes at the end.
+    """
+
+    unit = UnitOfWork()
+    token = _unit.set(unit)
+
+    try:
+        yield unit
+        await unit.flush()
+    finally:
+        _unit.reset(token)
+
+
+async def flush() -> None:
+    """
+    Run the writes queued by the current unit of work, if any, so they
+    are stored before a reply reports them done.
+    """
+
+    unit = _unit.get()
+
+    if unit is not None:
+        await unit.flush()
+
+
+def refresh() -> None:
+    """
+    Drop the reads kept by the current unit of work, so that a command
+    that waited on a user, letting other commands run, reads their
+    changes.
+    """
+
+    unit = _unit.get()
+
+    if unit is not None:
+        unit.forget("*")
+
+
+@asynccontextmanager
+async def _transaction():
+    """
+    Yield a transaction for writes whose results are not needed: the
+    current unit of work's, or one run when the block exits.
+    """
+
+    unit = _unit.get()
+
+    if unit is not None:
+        yield unit.writes()
+        return
+
+    async with db_connection() as db:
+        async with db.pipeline(transaction=True) as pipe:
+            yield pipe
+            await pipe.execute()
+
+
+async def prefetch(
+        role: object,
+        *users: object) -> None:
+    """
+    Read a GK role's entry, its permsets and the memberships of `users`
+    in one pipelined round trip, for the reads of the current unit of
+    work. Whatever is already kept or cached is skipped.
+    """
+
+    key = f"guild:{role.guild.id}:role:{role.id}"
+    await _migrate_role(key)
+
+    permsets_key = role_permsets_key(key)
+    reads = [read for read in (key, permsets_key)
+             if _recall(read) is Cache.MISSING]
+    users = [user for user in users
+             if _recall(f"{key}:member:{user.id}") is Cache.MISSING]
+
+    if not reads and not users:
+        return
+
+    version = cache.version
+    get = db_connection.scripts["get_members"]
+
+    async with db_connection() as db:
+        async with db.pipeline(transaction=True) as pipe:
+            if key in reads:
+                pipe.sismember(role_registry_key(role.guild.id), role.id)
+            if permsets_key in reads:
+                pipe.hgetall(permsets_key)
+            if users:
+                await get(
+                    keys=[permsets_key],
+                    args=[member_buckets_key(key)] + [
+                        user.id for user in users],
+                    client=pipe)
+            values = await pipe.execute()
+
+    for read, value in zip(reads, values):
+        if read == key:
+            value = bool(value)
+        _remember(read, value, version)
+
+    if users:
+        for user, permset_id in zip(users, values[-1]):
+            _remember(f"{key}:member:{user.id}", permset_id, version)
+
+
+def role_registry_key(
+        guild_id: int) -> str:
+    """
+    Key of the set holding the ids of a guild's GK roles.
+    """
+
+    return f"guild:{guild_id}:roles"
+
+
+def role_permsets_key(
+        role_key: str) -> str:
+    """
+    Key of the hash of a role's permsets, of permset id to "mask:name".
+    The "next" field counts the ids handed out, and "members", "buckets"
+    and "split" track how the members are spread over their buckets.
+    """
+
+    return f"{role_key}:permsets"
+
+
+def member_buckets_key(
+        role_key: str) -> str:
+    """
+    Key prefix of a role's member buckets, hashes of user id to permset
+    id numbered from 0. See `bot.scripts.BUCKETS` for which bucket holds
+    which member.
+    """
+
+    return f"{role_key}:members:"
+
+
+def bucket_count(
+        permsets: dict) -> int:
+    """
+    Return how many member buckets a role has, from its permsets hash.
+    """
+
+    return int(permsets.get(b"buckets", 1)) + int(permsets.get(b"split", 0))
+
+
+def user_roles_key(
+        guild_id: int,
+        user_id: int) -> str:
+    """
+    Key of the set holding the ids of the GK roles a user is a member of
+    in a guild.
+    """
+
+    return f"guild:{guild_id}:user:{user_id}:roles"
+
+
+def _role_ids(
+        role_key: str) -> tuple:
+    """
+    Return the guild and role ids of a role key.
+    """
+
+    match = re.search(r"guild:(\d+):role:(\d+)$", role_key)
+    return match.group(1), match.group(2)
+
+
 class CreationError(Exception):
     pass
 
@@ -27,6 +550,10 @@ class DataSet:
 class Permset(DataSet):
     """
     Object representing a permset database entry.
+
+    A permset is one field of its role's permsets hash, under a numeric
+    id. Members refer to that id, so renaming a permset or changing its
+    permissions never touches them.
     """
 
     def __str__(self):
@@ -35,69 +562,86 @@ class Permset(DataSet):
     @property
     def giveable(self):
         """
-        Return a list of permissions that can be granted to new Permsets
+        Return the permissions that can be granted to new Permsets
         created by a member of this Permset.
         """
 
-        permissions = self.permissions
+        managing = Permission.MANAGE_USERS | Permission.MANAGE_PERMSETS
 
-        try:
-            permissions.remove(Permission.MANAGE_USERS)
-            permissions.remove(Permission.MANAGE_PERMSETS)
-            return permissions
-        except ValueError:
+        if self.permissions & managing != managing:
             return None
+        return self.permissions & ~managing
 
-    @property
-    def role(self):
+    async def role(self):
         """
         Return a role this permset is related to.
         """
 
-        match = re.search(r"([\w\d:]+):permset:", self.key_prefix)
-        return Role.get_raw(match.group(1))
+        return await Role.get_raw(self.role_key)
 
-    @property
-    def _member_keys(self) -> list:
+    async def members(self) -> list:
         """
-        Return all members of this permset.
+        Return the ids of all members of this permset.
         """
 
-        match = re.search(r"([\w\d:]+):permset:", self.key_prefix)
-        result = f"{match.group(1)}:member:*"
-
-        with db_connection() as db:
-            def check(result):
-                return True if db.get(result).decode() == self.name else False
-
-            results = filter(check, db.scan_iter(match=result))
+        return [
+            uid async for uid, permset_id in
+            Role(key=self.role_key).scan_members()
+            if permset_id == self.id]
 
-        return [r.decode() for r in results]
-
-    def add_member(
+    async def add_member(
             self,
             user: object) -> None:
         """
         Add a user to this permset.
         """
 
-        user_key = f"{self.role.key}:member:{user.id}"
+        await self.add_members([user])
 
-        with db_connection() as db:
-            db.set(user_key, self.name)
+    async def add_members(
+            self,
+            users: list) -> list:
+        """
+        Move members of the role into this permset, out of their previous
+        one, in a single transaction. Users who are not members are
+        skipped.
+
+        Return the users that were moved.
+        """
 
-    def has_permission(self, permission: object) -> bool:
+        if not users:
+            return []
+
+        guild_id, role_id = _role_ids(self.role_key)
+        set_members = db_connection.scripts["set_members"]
+
+        async with db_connection() as db:
+            async with db.pipeline(transaction=True) as pipe:
+                await set_members(
+                    keys=[role_permsets_key(self.role_key)],
+                    args=[
+                        member_buckets_key(self.role_key),
+                        f"guild:{guild_id}:user:",
+                        role_id,
+                        "XX",
+                        self.id,
+                    ] + [user.id for user in users],
+                    client=pipe)
+                _invalidate(pipe, *[
+                    f"{self.role_key}:member:{user.id}" for user in users])
+                results = await pipe.execute()
+
+        return [user for user, moved in zip(users, results[0]) if moved]
+
+    def has_permission(self, permission: Permission) -> bool:
         """
         Check if a permset has a permission.
         """
 
-        for my_permission in self.permissions:
-            if my_permission().value == permission.value:
-                return True
-        return False
+        return self.permissions & permission == permission
 
     @staticmethod
-    def exists(
+    async def exists(
             name: str,
             role: object = None,
             key: str = None) -> bool:
@@ -108,169 +652,313 @@ class Permset(DataSet):
         if key:
             role_key = key
         elif role:
-            role_key = Role.get(role).key
+            role_key = f"guild:{role.guild.id}:role:{role.id}"
         else:
             raise RuntimeError
-        key = f"{role_key}:permset:{name}"
-
-        with db_connection() as db:
-            return db.exists(key)
+        return await Permset.get_raw(role_key, name) is not None
 
     @staticmethod
-    def get(
+    async def get(
             role: object,
             name: str) -> object or None:
         """
         Get a Permset object by role and name.
         """
 
-        return Permset.get_raw(f"guild:{role.guild.id}:role:{role.id}:permset:{name}")
+        return await Permset.get_raw(
+            f"guild:{role.guild.id}:role:{role.id}",
+            name)
 
     @staticmethod
-    def get_raw(
-            key: str) -> list:
+    async def get_raw(
+            role_key: str,
+            name: str) -> object or None:
+        """
+        Get a Permset object by role key and name.
+        """
+
+        for permset in (await Permset._all(role_key)).values():
+            if permset.name == name:
+                return permset
+        return None
+
+    @staticmethod
+    async def _all(
+            role_key: str) -> dict:
+        """
+        Return a role's permsets by id, reading the hash through the cache.
+        """
+
+        await _migrate_role(role_key)
+
+        key = role_permsets_key(role_key)
+        raw = _recall(key)
+
+        if raw is Cache.MISSING:
+            version = cache.version
+            async with db_connection() as db:
+                raw = await db.hgetall(key)
+            _remember(key, raw, version)
+
+        return Permset._from_hash(role_key, raw)
+
+    @staticmethod
+    def _from_hash(
+            role_key: str,
+            raw: dict) -> dict:
         """
-        Get a Permset object by database key.
+        Build Permset objects from a role's permsets hash, by id.
         """
 
-        with db_connection() as db:
-            permints = db.smembers(key)
+        permsets = {}
 
-        if permints:
-            permissions = [Permission.from_value(p.decode()) for p in permints]
-            match = re.search(r"(guild:\d+:role:\d+:permset:)(.+$)", key)
-            key_prefix = match.group(1)
-            name = match.group(2)
-            return Permset(
+        for id, value in raw.items():
+            if not id.isdigit():
+                continue
+            mask, _, name = value.decode().partition(":")
+            permsets[int(id)] = Permset(
+                id=int(id),
                 name=name,
-                key_prefix=key_prefix,
-                permissions=permissions)
-        return None
+                role_key=role_key,
+                permissions=Permission(int(mask)))
+
+        return permsets
 
     @staticmethod
-    def get_all(
+    async def get_all(
             role: object) -> list:
         """
         Get all Permsets for a role.
         """
 
-        role_key = Role.get(role).key
-        match = f"{role_key}:permset:*"
+        role_entry = await Role.get(role)
 
-        with db_connection() as db:
-            results = db.scan_iter(match=match)
+        if not role_entry:
+            return []
 
-        return [Permset.get_raw(key.decode()) for key in results]
+        return await role_entry.permsets()
 
     @staticmethod
-    def for_user(
+    async def for_user(
             role,
             user):
         """
         Get the Permset object for a user.
         """
 
-        key_prefix = f"guild:{role.guild.id}:role:{role.id}:"
+        return await Permset._for_member(
+            f"guild:{role.guild.id}:role:{role.id}",
+            user.id)
+
+    @staticmethod
+    async def _for_member(
+            role_key: str,
+            user_id: int) -> object or None:
+        """
+        Get a member's Permset, reading the membership and the permsets
+        hash in one transaction when either is not cached.
+        """
+
+        await _migrate_role(role_key)
+
+        member_key = f"{role_key}:member:{user_id}"
+        permsets_key = role_permsets_key(role_key)
+
+        permset_id = _recall(member_key)
+        raw = _recall(permsets_key)
+
+        if permset_id is Cache.MISSING or raw is Cache.MISSING:
+            version = cache.version
+            get = db_connection.scripts["get_members"]
+
+            async with db_connection() as db:
+                async with db.pipeline(transaction=True) as pipe:
+                    await get(
+                        keys=[permsets_key],
+                        args=[member_buckets_key(role_key), user_id],
+                        client=pipe)
+                    pipe.hgetall(permsets_key)
+                    (permset_id,), raw = await pipe.execute()
+
+            _remember(member_key, permset_id, version)
+            _remember(permsets_key, raw, version)
 
-        with db_connection() as db:
-            name = db.get(
-                f"{key_prefix}member:{user.id}")
+        if permset_id is None:
+            return None
 
-        return Permset.get_raw(f"{key_prefix}permset:{name.decode()}")
+        return Permset._from_hash(role_key, raw).get(int(permset_id))
 
     @staticmethod
-    def create(
+    async def create(
             role: object,
             name: str,
-            permissions: list) -> object:
+            permissions: Permission) -> object:
         """
         Create an entry for a permission set in the database.
         Return an object representing that entry.
         """
 
-        permints = [perm().value for perm in permissions]
-        key_prefix = f"guild:{role.guild.id}:role:{role.id}:permset:"
-        key = f"{key_prefix}{name}"
+        role_key = f"guild:{role.guild.id}:role:{role.id}"
+        save = db_connection.scripts["save_permset"]
 
-        with db_connection() as db:
-            if db.exists(key):
+        async with db_connection() as db:
+            id = await save(
+                keys=[role_permsets_key(role_key)],
+                args=["", name, int(permissions)],
+                client=db)
+            if not id:
                 raise CreationError(
                     "Permission set entry already exists.")
-            db.sadd(key, *permints)
+            await _invalidate(db, role_permsets_key(role_key))
 
         return Permset(
+            id=id,
             name=name,
-            key_prefix=key_prefix,
+            role_key=role_key,
             permissions=permissions)
 
-    def update(
+    async def update(
             self,
             name: str = None,
-            permissions: list = None):
+            permissions: Permission = None):
         """
         Update a Permset in place, as well as its database entry.
-        """
-
-        if name:
-            with db_connection() as db:
-                permints = db.smembers(f"{self.key_prefix}{self.name}")
-                db.sadd(f"{self.key_prefix}{name}", *permints)
-                db.delete(f"{self.key_prefix}{self.name}")
-            self.name = name
 
-        if permissions:
-            permints = [perm().value for perm in permissions]
-            with db_connection() as db:
-                db.delete(f"{self.key_prefix}{self.name}")
-                db.sadd(f"{self.key_prefix}{self.name}", *permints)
-            self.permissions = permissions
+        Changes that keep the name cannot clash with another permset, so
+        they are queued on the unit of work, if any. Nothing is written
+        if the permset was deleted since it was read.
+        """
 
-    def delete(
+        name = name or self.name
+        permissions = permissions or self.permissions
+        save = db_connection.scripts["save_permset"]
+
+        if name == self.name:
+            async with _transaction() as pipe:
+                await save(
+                    keys=[role_permsets_key(self.role_key)],
+                    args=[self.id, name, int(permissions)],
+                    client=pipe)
+                _invalidate(pipe, role_permsets_key(self.role_key))
+        else:
+            async with db_connection() as db:
+                saved = await save(
+                    keys=[role_permsets_key(self.role_key)],
+                    args=[self.id, name, int(permissions)],
+                    client=db)
+                if saved == -1:
+                    raise CreationError(
+                        "Permission set entry no longer exists.")
+                if not saved:
+                    raise CreationError(
+                        "Permission set entry already exists.")
+                await _invalidate(db, role_permsets_key(self.role_key))
+
+        self.name = name
+        self.permissions = permissions
+
+    async def delete(
             self):
         """
-        Delete a Permset and its database entry.
+        Delete a Permset and its database entry, then remove its members
+        from the role, a batch of buckets per script call.
         """
 
-        with db_connection() as db:
-            db.delete(f"{self.key_prefix}{self.name}", *self._member_keys)
+        guild_id, role_id = _role_ids(self.role_key)
+        unassign = db_connection.scripts["unassign_permset"]
+
+        async with db_connection() as db:
+            await db.hdel(role_permsets_key(self.role_key), self.id)
+            await _invalidate(db, role_permsets_key(self.role_key))
+
+            start, buckets = 0, 1
+            while start < buckets:
+                _, buckets = await unassign(
+                    keys=[role_permsets_key(self.role_key)],
+                    args=[
+                        self.id,
+                        member_buckets_key(self.role_key),
+                        f"guild:{guild_id}:user:",
+                        role_id,
+                        start,
+                        BUCKET_BATCH],
+                    client=db)
+                start += BUCKET_BATCH
+            await _invalidate(db, f"{self.role_key}:member:*")
 
 
 class Role(DataSet):
     """
     Object representing a role database entry.
+
+    The role's id is kept in its guild's role registry. Its permsets
+    live in one hash, and its members in buckets, hashes of user id to
+    permset id. A role gets one more bucket for every `BUCKET_FILL`
+    members in `bot.scripts`, so each stays small enough for Redis to
+    store compactly.
+    Each member's GK roles are also listed in a per guild user role
+    index, so a user leaving the guild is removed without a scan. When a
+    role is deleted, its buckets are queued and its members' index
+    entries dropped in the background by `clean_deleted`. Readers skip
+    ids that are not in the registry in the meantime.
     """
 
-    @property
-    def members(self) -> list:
+    async def scan_members(self):
         """
-        All members in this role.
+        Yield (user id, permset id) for every member, reading a batch of
+        buckets per script call.
         """
 
-        match = f"{self.key}:member:*"
+        await _migrate_role(self.key)
 
-        with db_connection() as db:
-            results = db.scan_iter(match=match)
+        permsets_key = role_permsets_key(self.key)
+        scan = db_connection.scripts["scan_members"]
 
-        members = []
-        for result in results:
-            match = re.search(r"[\w\d:]+:member:(.+$)", result.decode())
-            user_id = int(match.group(1))
-            members.append(user_id)
+        async with db_connection() as db:
+            buckets, split = await db.hmget(permsets_key, "buckets", "split")
+            buckets, split = int(buckets or 1), int(split or 0)
 
-        return members
+            for start in range(0, buckets + split, BUCKET_BATCH):
+                entries = await scan(
+                    keys=[permsets_key],
+                    args=[
+                        member_buckets_key(self.key),
+                        buckets,
+                        split,
+                        start,
+                        BUCKET_BATCH],
+                    client=db)
 
-    @property
-    def permsets(self) -> list:
+                for i in range(0, len(entries), 2):
+                    yield int(entries[i]), int(entries[i + 1])
+
+    async def bucket_keys(self) -> list:
         """
-        All permsets for this role.
+        Keys of every member bucket of this role.
         """
 
-        with db_connection() as db:
-            results = db.scan_iter(match=f"{self.key}:permset:*")
+        async with db_connection() as db:
+            permsets = await db.hgetall(role_permsets_key(self.key))
+
+        return [
+            f"{member_buckets_key(self.key)}{bucket}"
+            for bucket in range(bucket_count(permsets))]
+
+    async def members(self) -> list:
+        """
+        All members in this role.
+        """
+
+        return [uid async for uid, _ in self.scan_members()]
+
+    async def permsets(self) -> list:
+        """
+        All permsets for this role.
+        """
 
-        return [Permset.get_raw(r.decode()) for r in results]
+        return list((await Permset._all(self.key)).values())
 
-    def add_member(
+    async def add_member(
             self,
             user: object,
             permset: str) -> None:
@@ -278,15 +966,48 @@ class Role(DataSet):
         Add a user to this role under a permset by its name.
         """
 
-        if Permset.exists(permset, key=self.key):
-            user_key = f"{self.key}:member:{user.id}"
+        if await Permset.exists(permset, key=self.key):
+            if not await self.add_members([user], permset):
+                raise CreationError()
 
-            with db_connection() as db:
-                if db.exists(user_key):
-                    raise CreationError()
-                db.set(user_key, permset)
+    async def add_members(
+            self,
+            users: list,
+            permset: str) -> list:
+        """
+        Add users to this role under a permset by its name, in a single
+        transaction. Users who are already members are skipped.
 
-    def update_member(
+        Return the users that were added.
+        """
+
+        permset = await Permset.get_raw(self.key, permset)
+
+        if not users or not permset:
+            return []
+
+        guild_id, role_id = _role_ids(self.key)
+        set_members = db_connection.scripts["set_members"]
+
+        async with db_connection() as db:
+            async with db.pipeline(transaction=True) as pipe:
+                await set_members(
+                    keys=[role_permsets_key(self.key)],
+                    args=[
+                        member_buckets_key(self.key),
+                        f"guild:{guild_id}:user:",
+                        role_id,
+                        "NX",
+                        permset.id,
+                    ] + [user.id for user in users],
+                    client=pipe)
+                _invalidate(pipe, *[
+                    f"{self.key}:member:{user.id}" for user in users])
+                results = await pipe.execute()
+
+        return [user for user, added in zip(users, results[0]) if added]
+
+    async def update_member(
             self,
             user: object,
             permset: str) -> None:
@@ -294,66 +1015,149 @@ class Role(DataSet):
         Change a members permset.
         """
 
-        if Permset.exists(permset, key=self.key):
-            user_key = f"{self.key}:member:{user.id}"
-
-            with db_connection() as db:
-                if db.exists(user_key):
-                    db.set(user_key, permset)
-
-    def check_member_for_perm(
+        permset = await Permset.get_raw(self.key, permset)
+
+        if permset:
+            guild_id, role_id = _role_ids(self.key)
+            set_members = db_connection.scripts["set_members"]
+
+            async with _transaction() as pipe:
+                await set_members(
+                    keys=[role_permsets_key(self.key)],
+                    args=[
+                        member_buckets_key(self.key),
+                        f"guild:{guild_id}:user:",
+                        role_id,
+                        "XX",
+                        permset.id,
+                        user.id],
+                    client=pipe)
+                _invalidate(pipe, f"{self.key}:member:{user.id}")
+
+    async def check_member_for_perm(
             self,
             user: object,
             permission: object) -> bool:
         """
         Check a user for a specific permission.
+
+        Answered from the membership and permsets when both were read
+        earlier in the unit of work or are cached, otherwise by the
+        check_permission script in a single round trip.
         """
 
-        user_key = f"{self.key}:member:{user.id}"
+        await _migrate_role(self.key)
+
+        permsets_key = role_permsets_key(self.key)
+        permset_id = _recall(f"{self.key}:member:{user.id}")
+        raw = _recall(permsets_key)
+
+        if permset_id is not Cache.MISSING and raw is not Cache.MISSING:
+            if permset_id is None:
+                return False
+            permset = Permset._from_hash(self.key, raw).get(int(permset_id))
+            return permset is not None and permset.has_permission(permission)
 
-        with db_connection() as db:
-            permset_name = db.get(user_key).decode()
-        permset = Permset.get_raw(f"{self.key}:permset:{permset_name}")
+        check = db_connection.scripts["check_permission"]
 
-        return permset.has_permission(permission)
+        async with db_connection() as db:
+            return bool(await check(
+                keys=[permsets_key],
+                args=[member_buckets_key(self.key), user.id, int(permission)],
+                client=db))
 
-    def remove_member(
+    async def remove_member(
             self,
             user: object) -> None:
         """
-        Remove a member from a role.
+        Remove a member from a role, in the unit of work if any.
         """
 
-        user_key = f"{self.key}:member:{user.id}"
+        guild_id, role_id = _role_ids(self.key)
+        remove = db_connection.scripts["remove_members"]
+
+        async with _transaction() as pipe:
+            await remove(
+                keys=[role_permsets_key(self.key)],
+                args=[
+                    member_buckets_key(self.key),
+                    f"guild:{guild_id}:user:",
+                    role_id,
+                    user.id],
+                client=pipe)
+            _invalidate(pipe, f"{self.key}:member:{user.id}")
+
+    async def remove_members(
+            self,
+            users: list) -> list:
+        """
+        Remove users from a role in a single transaction.
+
+        Return the users that were members.
+        """
+
+        if not users:
+            return []
+
+        guild_id, role_id = _role_ids(self.key)
+        remove = db_connection.scripts["remove_members"]
 
-        with db_connection() as db:
-            db.delete(user_key)
+        async with db_connection() as db:
+            async with db.pipeline(transaction=True) as pipe:
+                await remove(
+                    keys=[role_permsets_key(self.key)],
+                    args=[
+                        member_buckets_key(self.key),
+                        f"guild:{guild_id}:user:",
+                        role_id,
+                    ] + [user.id for user in users],
+                    client=pipe)
+                _invalidate(pipe, *[
+                    f"{self.key}:member:{user.id}" for user in users])
+                results = await pipe.execute()
+
+        return [user for user, removed in zip(users, results[0]) if removed]
 
     @staticmethod
-    def get_raw(
+    async def get_raw(
             key: str) -> object:
         """
         Get a Role object by key.
         """
 
-        with db_connection() as db:
-            if not [r for r in db.scan_iter(match=f"{key}:*")]:
-                return None
+        # Ahead of the registry check, as a role moved from the legacy
+        # layout is only registered once moved.
+        await _migrate_role(key)
+
+        exists = _recall(key)
+
+        if exists is Cache.MISSING:
+            guild_id, role_id = _role_ids(key)
+            version = cache.version
+
+            async with db_connection() as db:
+                exists = bool(await db.sismember(
+                    role_registry_key(guild_id),
+                    role_id))
+            _remember(key, exists, version)
+
+        if not exists:
+            return None
 
         return Role(
             key=key)
 
     @staticmethod
-    def get(
+    async def get(
             role: object) -> object:
         """
         Get a Role object for Discord role.
         """
 
-        return Role.get_raw(f"guild:{role.guild.id}:role:{role.id}")
+        return await Role.get_raw(f"guild:{role.guild.id}:role:{role.id}")
 
     @staticmethod
-    def create(
+    async def create(
             role,
             user) -> object:
         """
@@ -362,40 +1166,138 @@ class Role(DataSet):
         """
 
         key = f"guild:{role.guild.id}:role:{role.id}"
-        user_key = f"{key}:member:{user.id}"
 
-        with db_connection() as db:
-            if db.exists(key):
+        async with db_connection() as db:
+            if not await db.sadd(role_registry_key(role.guild.id), role.id):
                 raise CreationError(
                     "Role already exists.")
+            await _invalidate(db, key)
 
-            admin = Permset.create(
+            admin = await Permset.create(
                 role,
                 "administrators",
                 Permission.all())
 
-            Permset.create(
+            await Permset.create(
                 role,
                 "default",
                 Permission.default())
 
-            db.set(user_key, admin.name)
+            await db_connection.scripts["set_members"](
+                keys=[role_permsets_key(key)],
+                args=[
+                    member_buckets_key(key),
+                    f"guild:{role.guild.id}:user:",
+                    role.id,
+                    "",
+                    admin.id,
+                    user.id],
+                client=db)
+            await _invalidate(db, f"{key}:member:{user.id}")
 
         return Role(
             key=key)
 
-    def delete(
-            self) -> None:
+    async def delete(
+            self) -> int:
+        """
+        Delete a role and its data in a single atomic script call. Its
+        member buckets are queued for `clean_deleted`.
+
+        Return how many keys were removed or queued.
+        """
+
+        guild_id, role_id = _role_ids(self.key)
+        delete = db_connection.scripts["delete_role"]
+
+        async with db_connection() as db:
+            removed = await delete(
+                keys=[
+                    role_registry_key(guild_id),
+                    role_permsets_key(self.key),
+                    DELETED_KEY],
+                args=[member_buckets_key(self.key), role_id],
+                client=db)
+            await _invalidate(db, self.key, f"{self.key}:*")
+
+        return removed
+
+    @staticmethod
+    async def clean_deleted(
+            count: int = BUCKET_BATCH) -> int:
+        """
+        Drop the user role index entries of up to `count` member buckets
+        of deleted roles, in one script call.
+
+        Return how many buckets were cleaned, 0 once none are left.
+        """
+
+        clean = db_connection.scripts["clean_deleted"]
+
+        async with db_connection() as db:
+            cleaned, _ = await clean(
+                keys=[DELETED_KEY],
+                args=[count],
+                client=db)
+
+        return cleaned
+
+    @staticmethod
+    async def purge_member(
+            guild_id: int,
+            user_id: int) -> int:
         """
-        Delete a role and its data.
+        Remove a user from every GK role of a guild, in one script call
+        that only touches the roles in the user's role index, or every
+        role in the registry while the indexes are being built.
+
+        Return how many roles the user was removed from.
         """
 
-        for permset in self.permsets:
-            permset.delete()
+        purge = db_connection.scripts["purge_user"]
+
+        async with db_connection() as db:
+            role_ids = await purge(
+                keys=[
+                    user_roles_key(guild_id, user_id),
+                    role_registry_key(guild_id)],
+                args=[
+                    f"guild:{guild_id}:role:",
+                    user_id,
+                    "" if _user_index else "registry"],
+                client=db)
+            if role_ids:
+                await _invalidate(db, *[
+                    f"guild:{guild_id}:role:{int(role_id)}:member:{user_id}"
+                    for role_id in role_ids])
+
+        return len(role_ids)
 
-        with db_connection() as db:
-            for member in self.members:
-                key = f"{self.key}:member:{member}"
-                db.delete(key)
+    @staticmethod
+    async def purge_guild(
+            guild_id: int,
+            pause: float = 0.01) -> int:
+        """
+        Delete every GK role of a guild, one role at a time with a pause
+        in between, so a large guild is removed in the background without
+        holding up Redis.
+
+        Return how many roles were deleted.
+        """
 
-            db.delete(self.key)
+        registry = role_registry_key(guild_id)
+        count = 0
+
+        async with db_connection() as db:
+            while True:
+                role_ids = await db.srandmember(registry, BUCKET_BATCH)
+                if not role_ids:
+                    break
+                for role_id in role_ids:
+                    await Role(
+                        key=f"guild:{guild_id}:role:{role_id.decode()}"
+                    ).delete()
+                    count += 1
+                    await asyncio.sleep(pause)
+
+        return count
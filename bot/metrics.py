@@ -0,0 +1,301 @@
+"""
+Prometheus style metrics, kept in process and served as plain text.
+
+Metrics are registered on `REGISTRY` and rendered in the Prometheus text
+exposition format by a small HTTP server started with `serve`.
+"""
+
+import time
+import asyncio
+import functools
+
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(
+        names: tuple,
+        values: tuple,
+        extra: str = None) -> str:
+    pairs = [
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+class Counter:
+    """
+    A value that only goes up, per label set.
+    """
+
+    type = "counter"
+
+    def __init__(
+            self,
+            name: str,
+            description: str,
+            labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(
+            self,
+            *labels: object,
+            amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _labels(self.labels, labels), value
+
+
+class Gauge:
+    """
+    A value read from a callback whenever metrics are rendered.
+
+    The callback returns a dict mapping label value tuples to values.
+    """
+
+    type = "gauge"
+
+    def __init__(
+            self,
+            name: str,
+            description: str,
+            labels: tuple = (),
+            collect=None):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in (self.collect() if self.collect else {}).items():
+            yield self.name, _labels(self.labels, labels), value
+
+
+class Histogram:
+    """
+    A distribution of observed values, per label set.
+    """
+
+    type = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            description: str,
+            labels: tuple = (),
+            buckets: tuple = BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(
+            self,
+            value: float,
+            *labels: object) -> None:
+        entry = self._values.get(labels)
+
+        if entry is None:
+            entry = self._values[labels] = [[0] * len(self.buckets), 0, 0.0]
+
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += 1
+        entry[2] += value
+
+    def time(
+            self,
+            *labels: object) -> "_Timer":
+        """
+        Return a context manager observing how long its block takes.
+        """
+
+        return _Timer(self, labels)
+
+    def samples(self):
+        for labels, (counts, count, total) in self._values.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield (
+                    f"{self.name}_bucket",
+                    _labels(self.labels, labels, f'le="{bound}"'),
+                    cumulative)
+            yield (
+                f"{self.name}_bucket",
+                _labels(self.labels, labels, 'le="+Inf"'),
+                count)
+            yield f"{self.name}_count", _labels(self.labels, labels), count
+            yield f"{self.name}_sum", _labels(self.labels, labels), total
+
+
+class _Timer:
+    def __init__(
+            self,
+            histogram: Histogram,
+            labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.histogram.observe(
+            time.perf_counter() - self.start,
+            *self.labels)
+
+
+class Registry:
+    """
+    A collection of metrics rendered together.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(
+            self,
+            metric: object) -> object:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+        """
+
+        lines = []
+
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+COMMAND_SECONDS = REGISTRY.register(Histogram(
+    "gk_command_seconds",
+    "Time taken to handle a message command.",
+    ("command",)))
+
+EVENT_SECONDS = REGISTRY.register(Histogram(
+    "gk_event_seconds",
+    "Time taken by a gateway event handler.",
+    ("event",)))
+
+REDIS_SECONDS = REGISTRY.register(Histogram(
+    "gk_redis_command_seconds",
+    "Round trip time of Redis commands and pipelines.",
+    ("command",)))
+
+COMMAND_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "gk_command_wait_seconds",
+    "Time a command waited in its guild's queue before running."))
+
+COMMANDS_REJECTED = REGISTRY.register(Counter(
+    "gk_commands_rejected_total",
+    "Commands refused because their guild's queue was full."))
+
+COMMANDS_RATE_LIMITED = REGISTRY.register(Counter(
+    "gk_commands_rate_limited_total",
+    "Commands refused by a rate limit.",
+    ("command",)))
+
+DISCORD_REQUESTS = REGISTRY.register(Counter(
+    "gk_discord_requests_total",
+    "Discord HTTP API requests made.",
+    ("method", "route", "status")))
+
+SWEEPER_FINDINGS = REGISTRY.register(Counter(
+    "gk_sweeper_findings_total",
+    "Inconsistencies confirmed by the keyspace sweeper.",
+    ("kind",)))
+
+SWEEPER_REPAIRS = REGISTRY.register(Counter(
+    "gk_sweeper_repairs_total",
+    "Inconsistencies repaired by the keyspace sweeper.",
+    ("kind",)))
+
+
+def timed_event(handler):
+    """
+    Decorate a coroutine event handler to record its run time.
+    """
+
+    event = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        with EVENT_SECONDS.time(event):
+            return await handler(*args, **kwargs)
+
+    return wrapper
+
+
+async def _handle(
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        registry: Registry) -> None:
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+
+        parts = request.decode("latin-1").split()
+
+        if len(parts) >= 2 and parts[0] == "GET" and \
+                parts[1].split("?")[0] == "/metrics":
+            status = "200 OK"
+            body = registry.render().encode()
+        else:
+            status = "404 Not Found"
+            body = b"Not found.\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(
+        port: int,
+        host: str = "127.0.0.1",
+        registry: Registry = REGISTRY) -> asyncio.AbstractServer:
+    """
+    Serve a registry's metrics over HTTP at /metrics.
+
+    Only local scrapers can reach it by default. Bind to "0.0.0.0", or
+    the address a scraper reaches the host on, to serve it further.
+    """
+
+    return await asyncio.start_server(
+        lambda reader, writer: _handle(reader, writer, registry),
+        host,
+        port)
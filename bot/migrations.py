@@ -0,0 +1,684 @@
+"""
+Versioned migrations of the Redis keyspace, run online.
+
+The keyspace's schema version is kept in the `gk:schema` hash. Each
+migration walks the keys matching its pattern with SCAN, one batch at a
+time, and saves the cursor next to the version after every batch, so it
+never blocks Redis and picks up where it left off after a restart.
+
+Every bot process runs `run` in the background. Batches are taken by
+whichever process holds the migration lock, and while a migration that
+can move single roles is running, every process also moves each role
+the first time it reads it, so commands never see a half migrated role.
+Until the indexes roles are found by are built, a role read is found by
+a SCAN matching its keys, as the bot did before migrations, and moved
+straight into the latest layout. Commands are only refused until a
+process has read the schema version, or while a migration marked
+offline runs.
+
+    python -m bot.migrations [redis url]
+    python -m bot.migrations status [redis url]
+"""
+
+import re
+import sys
+import time
+import uuid
+import asyncio
+
+from bot import db
+from bot.db import Role
+from bot.db import _invalidate
+from bot.db import _role_ids
+from bot.db import RedisError
+from bot.db import db_connection
+from bot.db import member_buckets_key
+from bot.db import role_permsets_key
+from bot.db import role_registry_key
+from bot.db import use_role_migration
+from bot.db import use_user_index
+from bot.db import user_roles_key
+from bot.scripts import BUCKET_FILL
+from bot.utils import Permission
+
+# Hash of the schema version and the progress of the running migration.
+SCHEMA_KEY = "gk:schema"
+
+# Held by the process running a migration batch. A role being packed is
+# locked under "<LOCK_KEY>:<role key>".
+LOCK_KEY = "gk:schema:lock"
+
+# Milliseconds before the lock of a stalled batch expires. Migrations
+# are safe to run twice on the same keys, so a slow batch overlapping
+# the next one does no harm. Role locks are extended as packing goes.
+LOCK_TIMEOUT = 60000
+
+# The schema version from which every member is in its user role index.
+USER_INDEX_VERSION = 5
+
+# Keys walked per SCAN call, and members moved per pipeline when packing.
+SCAN_BATCH = 500
+PACK_BATCH = 500
+
+# Seconds between the batches of a running migration, so it does not
+# compete with commands, and between checks while another process holds
+# the lock.
+PAUSE = 0.05
+POLL = 5.0
+
+# Permission values used when permsets were stored as sets of ints.
+LEGACY_PERMISSIONS = {
+    1: Permission.INVITE_USERS,
+    2: Permission.REMOVE_USERS,
+    3: Permission.MANAGE_USERS,
+    4: Permission.MANAGE_PERMSETS,
+}
+
+
+def permset_members_key(
+        role_key: str,
+        name: str) -> str:
+    """
+    Key of the legacy set holding the user ids granted a permset.
+    """
+
+    return f"{role_key}:index:permset:{name}"
+
+
+def role_members_key(
+        role_key: str) -> str:
+    """
+    Key of the legacy set holding the user ids of a role's members.
+    """
+
+    return f"{role_key}:index:members"
+
+
+def role_permset_names_key(
+        role_key: str) -> str:
+    """
+    Key of the legacy set holding the names of a role's permsets.
+    """
+
+    return f"{role_key}:index:permsets"
+
+
+async def _index_members(db, keys: list) -> int:
+    """
+    Add one batch of member keys to their permset member indexes.
+    """
+
+    async with db.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.get(key)
+        names = await pipe.execute()
+
+    async with db.pipeline(transaction=False) as pipe:
+        for key, name in zip(keys, names):
+            if not name:
+                continue
+            match = re.search(r"(guild:\d+:role:\d+):member:(\d+)$", key)
+            if not match:
+                continue
+            pipe.sadd(
+                permset_members_key(match.group(1), name.decode()),
+                match.group(2))
+            pipe.sadd(role_members_key(match.group(1)), match.group(2))
+        await pipe.execute()
+
+    return len([name for name in names if name])
+
+
+async def _index_roles(db, keys: list) -> int:
+    """
+    Add one batch of permset keys to their guild role registries and
+    role permset indexes.
+    """
+
+    count = 0
+
+    async with db.pipeline(transaction=False) as pipe:
+        for key in keys:
+            match = re.search(r"guild:(\d+):role:(\d+):permset:(.+)$", key)
+            if not match:
+                continue
+            role_key = f"guild:{match.group(1)}:role:{match.group(2)}"
+            pipe.sadd(role_registry_key(match.group(1)), match.group(2))
+            pipe.sadd(role_permset_names_key(role_key), match.group(3))
+            count += 1
+        await pipe.execute()
+
+    return count
+
+
+async def _convert_permsets(db, keys: list) -> int:
+    """
+    Convert one batch of permset keys still stored as sets.
+    """
+
+    keys = [
+        key for key in keys
+        if re.search(r"guild:\d+:role:\d+:permset:.+$", key)]
+
+    async with db.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.type(key)
+        types = await pipe.execute()
+
+    legacy = [k for k, t in zip(keys, types) if t in (b"set", "set")]
+    if not legacy:
+        return 0
+
+    async with db.pipeline(transaction=False) as pipe:
+        for key in legacy:
+            pipe.smembers(key)
+        values = await pipe.execute()
+
+    async with db.pipeline(transaction=True) as pipe:
+        for key, permints in zip(legacy, values):
+            permissions = Permission(0)
+            for permint in permints:
+                permissions |= LEGACY_PERMISSIONS.get(
+                    int(permint), Permission(0))
+            pipe.delete(key)
+            pipe.set(key, int(permissions))
+        await pipe.execute()
+
+    return len(legacy)
+
+
+async def convert_role(
+        role_key: str) -> None:
+    """
+    Move one legacy role straight into the packed layout as it is read,
+    ahead of the migrations building the indexes it would be found by.
+
+    Its keys are found by a SCAN matching them, so this is only done for
+    roles that still have one of the permsets every role was created
+    with, or were indexed already. Other legacy roles are moved by the
+    background batches.
+    """
+
+    async with db_connection() as db:
+        if not await db.exists(
+                f"{role_key}:permset:default",
+                f"{role_key}:permset:administrators",
+                role_permset_names_key(role_key)):
+            return
+
+        keys = [
+            key.decode() async for key in db.scan_iter(
+                match=f"{role_key}:*",
+                count=SCAN_BATCH)]
+        permsets = [key for key in keys if ":permset:" in key]
+        members = [key for key in keys if ":member:" in key]
+
+        await _convert_permsets(db, permsets)
+        await _index_roles(db, permsets)
+        for i in range(0, len(members), PACK_BATCH):
+            await _index_members(db, members[i:i + PACK_BATCH])
+        await _pack_role(db, role_key)
+
+
+async def _pack_registries(db, keys: list) -> int:
+    """
+    Pack every role of one batch of guild role registries.
+    """
+
+    count = 0
+
+    for registry in keys:
+        guild_id = registry.split(":")[1]
+        async for role_id in db.sscan_iter(registry, count=PACK_BATCH):
+            role_key = f"guild:{guild_id}:role:{role_id.decode()}"
+            if await _pack_role(db, role_key):
+                count += 1
+
+    return count
+
+
+async def pack_role(
+        role_key: str) -> None:
+    """
+    Pack one role ahead of the background migration, as it is read.
+    """
+
+    async with db_connection() as db:
+        await _pack_role(db, role_key)
+
+
+async def _pack_role(
+        db,
+        role_key: str,
+        batch_size: int = PACK_BATCH) -> bool:
+    """
+    Move a role from the legacy layout, a string key per member and
+    permset plus index sets, into the packed permset and member hashes.
+
+    Only one process packs a role at a time, under a lock of its own, and
+    the others wait for it to finish. Legacy keys are dropped as their
+    data is moved, so this is safe to run more than once, or again after
+    being interrupted. Return False if the role has no legacy data left.
+    """
+
+    lock = f"{LOCK_KEY}:{role_key}"
+    release = db_connection.scripts["release_lock"]
+
+    while True:
+        token = uuid.uuid4().hex
+        if not await db.set(lock, token, nx=True, px=LOCK_TIMEOUT):
+            await asyncio.sleep(PAUSE)
+            continue
+
+        try:
+            packed = await _pack_locked(db, role_key, lock, token, batch_size)
+        finally:
+            await release(keys=[lock], args=[token], client=db)
+
+        # None if the lock expired midway, and another process may have
+        # carried on from there.
+        if packed is not None:
+            return packed
+
+
+async def _pack_locked(
+        db,
+        role_key: str,
+        lock: str,
+        token: str,
+        batch_size: int) -> bool or None:
+    """
+    Pack a role while holding its lock, extending the lock before each
+    batch of writes. Return None as soon as the lock is lost.
+    """
+
+    extend = db_connection.scripts["extend_lock"]
+
+    # Sorted, so a rerun hands out the same permset ids.
+    names = sorted(
+        name.decode()
+        for name in await db.smembers(role_permset_names_key(role_key)))
+
+    if not names:
+        return False
+
+    async with db.pipeline(transaction=False) as pipe:
+        for name in names:
+            pipe.get(f"{role_key}:permset:{name}")
+        masks = await pipe.execute()
+
+    ids = {name: id for id, name in enumerate(names, 1)}
+    members = await db.scard(role_members_key(role_key))
+
+    # Nothing already in the packed layout is overwritten, so a rerun
+    # neither undoes changes made since nor hands out a permset id twice.
+    async with db.pipeline(transaction=True) as pipe:
+        for name, mask in zip(names, masks):
+            if mask is not None:
+                pipe.hsetnx(
+                    role_permsets_key(role_key),
+                    ids[name],
+                    f"{int(mask)}:{name}")
+        pipe.hsetnx(role_permsets_key(role_key), "next", len(names))
+        # Start out with as many buckets as the members need, rather
+        # than splitting them one at a time as they are moved.
+        pipe.hsetnx(
+            role_permsets_key(role_key),
+            "buckets",
+            1 << (members // BUCKET_FILL).bit_length())
+        await pipe.execute()
+
+    batch = []
+    async for uid in db.sscan_iter(
+            role_members_key(role_key),
+            count=batch_size):
+        batch.append(uid.decode())
+        if len(batch) >= batch_size:
+            if not await extend(
+                    keys=[lock], args=[token, LOCK_TIMEOUT], client=db):
+                return None
+            await _pack_members(db, role_key, ids, batch)
+            batch = []
+    if batch:
+        if not await extend(
+                keys=[lock], args=[token, LOCK_TIMEOUT], client=db):
+            return None
+        await _pack_members(db, role_key, ids, batch)
+
+    # The permset index goes last, so an interrupted run packs the role
+    # again.
+    await db.delete(
+        *[f"{role_key}:permset:{name}" for name in names],
+        *[permset_members_key(role_key, name) for name in names],
+        role_members_key(role_key),
+        role_permset_names_key(role_key))
+    await _invalidate(db, role_key, f"{role_key}:*")
+
+    return True
+
+
+async def _pack_members(
+        db,
+        role_key: str,
+        ids: dict,
+        uids: list) -> None:
+    """
+    Move one batch of a role's legacy member keys into its buckets.
+    """
+
+    member_keys = [f"{role_key}:member:{uid}" for uid in uids]
+    guild_id, role_id = _role_ids(role_key)
+    set_members = db_connection.scripts["set_members"]
+
+    async with db.pipeline(transaction=False) as pipe:
+        for key in member_keys:
+            pipe.get(key)
+        names = await pipe.execute()
+
+    permsets = {}
+    for uid, name in zip(uids, names):
+        if name is not None and name.decode() in ids:
+            permsets.setdefault(ids[name.decode()], []).append(uid)
+
+    async with db.pipeline(transaction=True) as pipe:
+        for permset_id, members in permsets.items():
+            await set_members(
+                keys=[role_permsets_key(role_key)],
+                args=[
+                    member_buckets_key(role_key),
+                    f"guild:{guild_id}:user:",
+                    role_id,
+                    "NX",
+                    permset_id,
+                ] + members,
+                client=pipe)
+        pipe.delete(*member_keys)
+        await pipe.execute()
+
+
+async def _index_role_users(db, keys: list) -> int:
+    """
+    Build the user role indexes of every role of one batch of guild role
+    registries, from the members in their buckets.
+    """
+
+    count = 0
+
+    for registry in keys:
+        guild_id = registry.split(":")[1]
+        async for role_id in db.sscan_iter(registry, count=PACK_BATCH):
+            role_id = role_id.decode()
+            role = Role(key=f"guild:{guild_id}:role:{role_id}")
+            pipe = db.pipeline(transaction=False)
+
+            async for uid, _ in role.scan_members():
+                pipe.sadd(user_roles_key(guild_id, uid), role_id)
+                count += 1
+                if len(pipe) >= PACK_BATCH:
+                    await pipe.execute()
+            await pipe.execute()
+
+    return count
+
+
+class Migration:
+    """
+    One step of the keyspace schema.
+
+    Params:
+        version: The schema version once the migration is done.
+        name: Describes the migration in progress reports.
+        match: The SCAN pattern of the keys the migration walks.
+        migrate: Coroutine function migrating a batch of keys, called
+            with the client and the decoded keys. Keys may be passed
+            more than once.
+        migrate_role: Coroutine function moving one role into the new
+            layout ahead of the batches, called with the role key. None
+            if the migration cannot move single roles.
+        online: Whether commands can run meanwhile. Commands are refused
+            until an offline migration is done.
+    """
+
+    def __init__(
+            self,
+            version: int,
+            name: str,
+            match: str,
+            migrate: object,
+            migrate_role: object = None,
+            online: bool = True):
+        self.version = version
+        self.name = name
+        self.match = match
+        self.migrate = migrate
+        self.migrate_role = migrate_role
+        self.online = online
+
+
+MIGRATIONS = [
+    Migration(
+        1, "permset bitmasks",
+        "guild:*:role:*:permset:*", _convert_permsets,
+        migrate_role=convert_role),
+    Migration(
+        2, "role indexes",
+        "guild:*:role:*:permset:*", _index_roles,
+        migrate_role=convert_role),
+    Migration(
+        3, "permset member indexes",
+        "guild:*:role:*:member:*", _index_members,
+        migrate_role=convert_role),
+    Migration(
+        4, "packed roles",
+        "guild:*:roles", _pack_registries, migrate_role=pack_role),
+    Migration(
+        5, "user role indexes",
+        "guild:*:roles", _index_role_users),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+# Stands in for the running migration until this process has read the
+# schema version, as roles may need moving as they are read.
+SCHEMA_CHECK = Migration(0, "schema version check", None, None, online=False)
+
+# The latest schema state this process has seen, for the metrics.
+_state = {}
+
+
+def pending(
+        version: int) -> Migration or None:
+    """
+    Return the next migration to run from a schema version.
+    """
+
+    for migration in MIGRATIONS:
+        if migration.version > version:
+            return migration
+    return None
+
+
+async def schema_state() -> dict:
+    """
+    Return the schema version and the progress of the running migration.
+
+    A keyspace without a version is taken to predate migrations, unless
+    it holds no GK keys, in which case it starts out at the latest
+    version. Other keys are ignored, as the Redis may be shared.
+    """
+
+    async with db_connection() as db:
+        raw = await db.hgetall(SCHEMA_KEY)
+        if b"version" not in raw and not await _has_guild_keys(db):
+            await db.hsetnx(SCHEMA_KEY, "version", SCHEMA_VERSION)
+            raw = await db.hgetall(SCHEMA_KEY)
+
+    raw = {field.decode(): value.decode() for field, value in raw.items()}
+    version = int(raw.get("version", 0))
+    migration = pending(version)
+
+    return {
+        "version": version,
+        "latest": SCHEMA_VERSION,
+        "migration": migration.name if migration else None,
+        "walked": int(raw.get("walked", 0)),
+        "started": float(raw["started"]) if "started" in raw else None,
+        "updated": float(raw["updated"]) if "updated" in raw else None,
+    }
+
+
+async def _has_guild_keys(db) -> bool:
+    """
+    Return whether any GK guild key exists, stopping at the first found.
+    """
+
+    async for _ in db.scan_iter(match="guild:*", count=SCAN_BATCH):
+        return True
+    return False
+
+
+def format_progress(
+        state: dict,
+        now: float) -> str:
+    """
+    Describe a schema state from `schema_state`.
+    """
+
+    if state["migration"] is None:
+        return f"Schema version {state['version']}, up to date."
+
+    text = (
+        f"Schema version {state['version']} of {state['latest']}, "
+        f"migrating {state['migration']}: {state['walked']} keys walked")
+
+    if state["updated"] is not None:
+        text += f", last batch {now - state['updated']:.0f}s ago"
+
+    return text + "."
+
+
+def offline() -> Migration or None:
+    """
+    Return the running migration if commands must wait for it to finish,
+    or `SCHEMA_CHECK` while the schema version has not been read yet.
+    """
+
+    if "version" not in _state:
+        return SCHEMA_CHECK
+
+    migration = pending(_state["version"])
+
+    if migration is not None and not migration.online:
+        return migration
+    return None
+
+
+def stats() -> dict:
+    """
+    Return the schema counters for the metrics endpoint.
+    """
+
+    return {
+        stat: _state[stat]
+        for stat in ("version", "latest", "walked") if stat in _state}
+
+
+async def step(
+        migration: Migration,
+        batch_size: int = SCAN_BATCH) -> bool:
+    """
+    Run the next batch of a migration and save its cursor, marking the
+    migration done once the cursor wraps around.
+
+    Return False without doing anything if another process holds the
+    lock.
+    """
+
+    token = uuid.uuid4().hex
+    release = db_connection.scripts["release_lock"]
+
+    async with db_connection() as db:
+        if not await db.set(LOCK_KEY, token, nx=True, px=LOCK_TIMEOUT):
+            return False
+
+        try:
+            version, cursor = await db.hmget(SCHEMA_KEY, "version", "cursor")
+            if int(version or 0) >= migration.version:
+                return True
+
+            now = time.time()
+            if cursor is None:
+                await db.hset(SCHEMA_KEY, "started", now)
+
+            cursor, keys = await db.scan(
+                int(cursor or 0),
+                match=migration.match,
+                count=batch_size)
+            await migration.migrate(db, [key.decode() for key in keys])
+
+            async with db.pipeline(transaction=True) as pipe:
+                if cursor:
+                    pipe.hset(SCHEMA_KEY, "cursor", cursor)
+                    pipe.hincrby(SCHEMA_KEY, "walked", len(keys))
+                    pipe.hset(SCHEMA_KEY, "updated", now)
+                else:
+                    pipe.hset(SCHEMA_KEY, "version", migration.version)
+                    pipe.hdel(SCHEMA_KEY, "cursor", "walked", "started")
+                    pipe.hset(SCHEMA_KEY, "updated", now)
+                await pipe.execute()
+        finally:
+            await release(keys=[LOCK_KEY], args=[token], client=db)
+
+    return True
+
+
+async def run(
+        batch_size: int = SCAN_BATCH,
+        pause: float = PAUSE,
+        poll: float = POLL) -> None:
+    """
+    Run every pending migration, a batch at a time, until the schema is
+    at the latest version.
+
+    Meanwhile, roles are moved as they are read whenever the running
+    migration supports it, and members leaving are looked up in every
+    role of their guild until the user role indexes are built. Redis
+    errors are waited out.
+    """
+
+    while True:
+        try:
+            _state.update(await schema_state())
+            migration = pending(_state["version"])
+
+            use_role_migration(migration and migration.migrate_role)
+            use_user_index(_state["version"] >= USER_INDEX_VERSION)
+            if migration is None:
+                return
+
+            ran = await step(migration, batch_size)
+        except (RedisError, OSError):
+            ran = False
+
+        await asyncio.sleep(pause if ran else poll)
+
+
+async def main(argv: list) -> None:
+    report = argv[:1] == ["status"]
+    argv = argv[1:] if report else argv
+    db.connect(argv[0] if argv else "redis://localhost:6379")
+
+    try:
+        await db.load_scripts()
+        if not report:
+            migrating = asyncio.ensure_future(run(pause=0, poll=1))
+            while not migrating.done():
+                print(format_progress(await schema_state(), time.time()))
+                await asyncio.wait([migrating], timeout=5)
+        print(format_progress(await schema_state(), time.time()))
+    finally:
+        await db.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,93 @@
+import time
+import pkgutil
+
+from importlib import import_module
+from types import MappingProxyType
+
+from bot.router import Router
+
+
+class Plugins:
+    """
+    Command and event tables collected from the plugin modules.
+
+    Built once at startup. Every table is read only: list events hold
+    tuples of callbacks, dict events hold read only mappings, and the
+    on_message prefixes are compiled into a Router. `rate_limits` maps
+    command prefixes to their overrides of the default rate limits.
+    """
+
+    def __init__(
+            self,
+            commands: dict = None,
+            timings: dict = None,
+            rate_limits: dict = None):
+        commands = commands or {}
+
+        self.commands = MappingProxyType({
+            event: _freeze(table) for event, table in commands.items()})
+        self.router = Router(commands.get("on_message", {}))
+        self.timings = MappingProxyType(timings or {})
+        self.rate_limits = _freeze(rate_limits or {})
+
+    def callbacks(
+            self,
+            event: str) -> tuple:
+        """
+        Return the callbacks registered for a list event.
+        """
+
+        return self.commands.get(event, ())
+
+
+def _freeze(table: object) -> object:
+    if isinstance(table, dict):
+        return MappingProxyType({
+            key: _freeze(value) for key, value in table.items()})
+    if isinstance(table, list):
+        return tuple(table)
+    return table
+
+
+def _merge(
+        into: dict,
+        table: dict) -> None:
+    """
+    Merge one plugin's command table into the combined one.
+    """
+
+    for key, value in table.items():
+        if isinstance(value, list):
+            into.setdefault(key, []).extend(value)
+        elif isinstance(value, dict):
+            _merge(into.setdefault(key, {}), value)
+        else:
+            into[key] = value
+
+
+def load_plugins(
+        package: str = "bot.commands") -> Plugins:
+    """
+    Import every module of a package and combine their `commands` and
+    `rate_limits` tables.
+
+    Modules are found through the package itself, so loading does not
+    depend on the working directory. The import time of each module is
+    recorded in `Plugins.timings`, in seconds.
+    """
+
+    commands = {}
+    timings = {}
+    rate_limits = {}
+
+    for module_info in pkgutil.iter_modules(import_module(package).__path__):
+        name = f"{package}.{module_info.name}"
+
+        start = time.perf_counter()
+        module = import_module(name)
+        timings[name] = time.perf_counter() - start
+
+        _merge(commands, getattr(module, "commands", {}))
+        _merge(rate_limits, getattr(module, "rate_limits", {}))
+
+    return Plugins(commands, timings, rate_limits)
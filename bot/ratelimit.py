@@ -0,0 +1,57 @@
+import time
+
+from bot.db import db_connection
+
+# Limits of every command, as (commands, seconds) per scope. Plugins
+# override them per prefix; a scope set to None is not limited.
+DEFAULT_LIMITS = {
+    "user": (5, 10.0),
+    "guild": (30, 10.0),
+}
+
+
+async def check(
+        message,
+        prefix: str,
+        limits: dict = None) -> tuple:
+    """
+    Count a command against its user and guild sliding windows.
+
+    Each command prefix has its own windows, and the command is only
+    counted when every window has room, in one atomic script call.
+
+    Params:
+        message: The Message that triggered the command.
+        prefix: The prefix of the command.
+        limits: The command's overrides of `DEFAULT_LIMITS`.
+
+    Return (retry, first): retry is 0 if the command may run, else how
+    many seconds until it may. first is True for the first refusal of a
+    streak, the only one worth responding to.
+    """
+
+    limits = {**DEFAULT_LIMITS, **(limits or {})}
+    scopes = {"user": message.author.id}
+
+    if message.guild:
+        scopes["guild"] = message.guild.id
+
+    keys = []
+    args = [int(time.time() * 1000), message.id]
+
+    for scope, id in scopes.items():
+        limit = limits.get(scope)
+        if limit:
+            keys.append(f"ratelimit:{prefix}:{scope}:{id}")
+            args.extend([limit[0], int(limit[1] * 1000)])
+
+    if not keys:
+        return 0, False
+
+    keys.append(f"ratelimit:{prefix}:notice:{message.author.id}")
+    limit = db_connection.scripts["rate_limit"]
+
+    async with db_connection() as db:
+        retry, first = await limit(keys=keys, args=args, client=db)
+
+    return retry / 1000, bool(first)
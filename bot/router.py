@@ -0,0 +1,53 @@
+class Router:
+    """
+    Dispatch table for message commands, compiled once from the prefixes
+    registered by plugins.
+
+    Prefixes are split into whitespace separated tokens and stored in a
+    trie, so matching a message costs one walk over its first few words
+    no matter how many commands exist. When prefixes overlap, only the
+    longest one matching the message is dispatched.
+    """
+
+    # Trie key under which a node stores its (prefix, callback) pair.
+    _END = None
+
+    def __init__(
+            self,
+            routes: dict):
+        self._root = {}
+        self._depth = 0
+
+        for prefix, callback in routes.items():
+            tokens = prefix.split()
+            node = self._root
+            for token in tokens:
+                node = node.setdefault(token, {})
+            node[Router._END] = (prefix, callback)
+            self._depth = max(self._depth, len(tokens))
+
+        # First characters of every command, to reject chatter before
+        # splitting the message at all.
+        self._initials = frozenset(token[0] for token in self._root)
+
+    def match(
+            self,
+            content: str) -> tuple or None:
+        """
+        Return the (prefix, callback) pair of the longest command prefix
+        the content starts with, or None.
+        """
+
+        if content[:1] not in self._initials:
+            return None
+
+        node = self._root
+        found = None
+
+        for token in content.split(None, self._depth)[:self._depth]:
+            node = node.get(token)
+            if node is None:
+                break
+            found = node.get(Router._END, found)
+
+        return found
@@ -0,0 +1,160 @@
+import time
+import asyncio
+import contextvars
+
+from contextlib import asynccontextmanager
+
+from bot.metrics import COMMAND_WAIT_SECONDS
+from bot.metrics import COMMANDS_REJECTED
+
+# How many commands may run at once across every guild.
+CONCURRENCY = 16
+
+# How many commands one guild may have running or waiting at once.
+MAX_QUEUED = 20
+
+# The queue and hold state of the slot the current task runs in.
+_current = contextvars.ContextVar("slot", default=None)
+
+
+class QueueFull(Exception):
+    """
+    Raised when a key already has `max_queued` commands in flight.
+    """
+
+
+class _Queue:
+    __slots__ = ("lock", "depth")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+
+class Scheduler:
+    """
+    Runs commands one at a time per key, usually a guild, in arrival
+    order, while commands of different keys run in parallel up to a
+    global cap.
+
+    A key's queue only takes a global slot once its command is next in
+    line, so a busy guild cannot starve the others. When a key already
+    has `max_queued` commands in flight, new ones are refused with
+    `QueueFull` instead of piling up.
+    """
+
+    def __init__(
+            self,
+            concurrency: int = CONCURRENCY,
+            max_queued: int = MAX_QUEUED):
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.running = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._queues = {}
+
+    def depth(
+            self,
+            key: object) -> int:
+        """
+        Return how many commands of a key are running or waiting.
+        """
+
+        queue = self._queues.get(key)
+        return queue.depth if queue else 0
+
+    def stats(self) -> dict:
+        """
+        Return queue depth counters for the metrics endpoint.
+        """
+
+        depths = [queue.depth for queue in self._queues.values()]
+
+        return {
+            "running": self.running,
+            "waiting": sum(depths) - self.running,
+            "keys": len(depths),
+            "deepest": max(depths, default=0),
+        }
+
+    async def _acquire(
+            self,
+            queue: _Queue) -> None:
+        await queue.lock.acquire()
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            queue.lock.release()
+            raise
+        self.running += 1
+
+    def _release(
+            self,
+            queue: _Queue) -> None:
+        self.running -= 1
+        self._slots.release()
+        queue.lock.release()
+
+    @asynccontextmanager
+    async def slot(
+            self,
+            key: object):
+        """
+        Wait for the key's turn and a free global slot, and hold both
+        for the block.
+        """
+
+        queue = self._queues.get(key)
+
+        if queue is None:
+            queue = self._queues[key] = _Queue()
+
+        if queue.depth >= self.max_queued:
+            COMMANDS_REJECTED.inc()
+            raise QueueFull(key)
+
+        queue.depth += 1
+        state = [queue, False]
+
+        try:
+            start = time.perf_counter()
+            await self._acquire(queue)
+            state[1] = True
+            COMMAND_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+            token = _current.set(state)
+            try:
+                yield
+            finally:
+                _current.reset(token)
+                if state[1]:
+                    self._release(queue)
+        finally:
+            queue.depth -= 1
+            if not queue.depth:
+                del self._queues[key]
+
+    @asynccontextmanager
+    async def released(self):
+        """
+        Give up the current task's slot for the block, such as while
+        waiting on a user, and queue for it again afterwards.
+
+        Does nothing outside of a slot.
+        """
+
+        state = _current.get()
+
+        if state is None or not state[1]:
+            yield
+            return
+
+        queue = state[0]
+        self._release(queue)
+        state[1] = False
+
+        try:
+            yield
+        finally:
+            await self._acquire(queue)
+            state[1] = True
@@ -0,0 +1,493 @@
+"""
+Lua scripts run server side by Redis.
+
+Each script is registered on the shared client by `bot.db.connect` and
+loaded with SCRIPT LOAD when the bot starts, so calls only send EVALSHA.
+"""
+
+# Average members per bucket at which a role's members are spread over
+# one more bucket. A bucket about to be split holds twice as many, still
+# well within Redis' default hash-max-listpack-entries of 128, under
+# which hashes keep the compact listpack encoding.
+BUCKET_FILL = 32
+
+# Functions shared by the scripts reading or writing member buckets.
+#
+# A role's members are spread over its buckets by linear hashing. The
+# role's permsets hash counts its "members" and holds "buckets", a power
+# of two, and "split", how many buckets have been split so far: bucket
+# b is split into b and b + buckets, and once all are, the count doubles.
+# A role starts out with a single bucket, and every FILL members joining
+# split one more, moving only that bucket's members, so a role grows a
+# bucket at a time without ever rehashing all of it.
+#
+# User ids are hashed, rather than taken modulo the bucket count, as
+# the low bits of snowflakes are mostly zeroes. The arithmetic stays
+# below 2^53, so it is exact in Lua's doubles.
+BUCKETS = """
+local FILL = %d
+
+local function member_hash(uid)
+    local h = 0
+    for i = 1, #uid do
+        h = (h * 257 + string.byte(uid, i)) %% 2147483647
+    end
+    for _ = 1, 2 do
+        h = h * 48271 %% 2147483647
+    end
+    return h
+end
+
+local function layout(permsets)
+    local state = redis.call("HMGET", permsets, "buckets", "split")
+    return tonumber(state[1]) or 1, tonumber(state[2]) or 0
+end
+
+local function bucket(h, buckets, split)
+    local b = h %% buckets
+    if b < split then
+        b = h %% (2 * buckets)
+    end
+    return b
+end
+
+local function count(permsets, delta)
+    if redis.call("EXISTS", permsets) == 0 then
+        return 0
+    end
+    return redis.call("HINCRBY", permsets, "members", delta)
+end
+
+local function grow(permsets, prefix, added)
+    local members = count(permsets, added)
+    local buckets, split = layout(permsets)
+    if members <= FILL * (buckets + split) then
+        return
+    end
+
+    while members > FILL * (buckets + split) do
+        local from = prefix .. split
+        local to = prefix .. (split + buckets)
+        local entries = redis.call("HGETALL", from)
+        for i = 1, #entries, 2 do
+            if member_hash(entries[i]) %% (2 * buckets) ~= split then
+                redis.call("HSET", to, entries[i], entries[i + 1])
+                redis.call("HDEL", from, entries[i])
+            end
+        end
+        split = split + 1
+        if split == buckets then
+            buckets, split = 2 * buckets, 0
+        end
+    end
+    redis.call("HSET", permsets, "buckets", buckets, "split", split)
+end
+""" % BUCKET_FILL
+
+# Create or rename a permset, keeping names unique within the role. An
+# existing permset is only saved while it still exists, so a write based
+# on an old read cannot bring back a deleted permset.
+#
+# KEYS[1]: The role's permsets hash, of permset id to "mask:name", next
+# to counters such as "next".
+# ARGV[1]: The permset id, or "" to create a new permset.
+# ARGV[2]: The permset name.
+# ARGV[3]: The permission mask.
+#
+# Return the permset id, 0 when another permset has the name, or -1 when
+# the permset no longer exists.
+SAVE_PERMSET = """
+if ARGV[1] ~= "" and redis.call("HEXISTS", KEYS[1], ARGV[1]) == 0 then
+    return -1
+end
+
+local entries = redis.call("HGETALL", KEYS[1])
+for i = 1, #entries, 2 do
+    if string.match(entries[i], "^%d+$") and entries[i] ~= ARGV[1] and
+            string.match(entries[i + 1], "^%d+:(.*)$") == ARGV[2] then
+        return 0
+    end
+end
+
+local id = ARGV[1]
+if id == "" then
+    id = redis.call("HINCRBY", KEYS[1], "next", 1)
+end
+redis.call("HSET", KEYS[1], id, ARGV[3] .. ":" .. ARGV[2])
+return tonumber(id)
+"""
+
+# Look up the permsets of some of a role's members.
+#
+# KEYS[1]: The role's permsets hash.
+# ARGV[1]: The key prefix of the role's member buckets.
+# ARGV[2..]: The user ids.
+#
+# Return the permset id of each user, or nil for users who are not
+# members.
+GET_MEMBERS = BUCKETS + """
+local buckets, split = layout(KEYS[1])
+local ids = {}
+for i = 2, #ARGV do
+    local key = ARGV[1] .. bucket(member_hash(ARGV[i]), buckets, split)
+    ids[i - 1] = redis.call("HGET", key, ARGV[i])
+end
+return ids
+"""
+
+# Check a member's permset for a permission in one round trip.
+#
+# KEYS[1]: The role's permsets hash.
+# ARGV[1]: The key prefix of the role's member buckets.
+# ARGV[2]: The user id.
+# ARGV[3]: The permission's bits.
+#
+# Return 1 if every bit is set on the member's permset, otherwise 0. The
+# bits are tested arithmetically, as the bit library is not in every
+# Redis' Lua.
+CHECK_PERMISSION = BUCKETS + """
+local buckets, split = layout(KEYS[1])
+local key = ARGV[1] .. bucket(member_hash(ARGV[2]), buckets, split)
+local id = redis.call("HGET", key, ARGV[2])
+if not id then return 0 end
+local permset = redis.call("HGET", KEYS[1], id)
+if not permset then return 0 end
+local mask = tonumber(string.match(permset, "^(%d+):"))
+local permission = tonumber(ARGV[3])
+while permission > 0 do
+    if permission % 2 == 1 and mask % 2 == 0 then return 0 end
+    mask = math.floor(mask / 2)
+    permission = math.floor(permission / 2)
+end
+return 1
+"""
+
+# Put some users in a permset, adding them to the role's user role
+# indexes, and split buckets for the members that joined.
+#
+# KEYS[1]: The role's permsets hash.
+# ARGV[1]: The key prefix of the role's member buckets.
+# ARGV[2]: The key prefix of the guild's user role indexes.
+# ARGV[3]: The role id.
+# ARGV[4]: "NX" to only add users who are not members, "XX" to only move
+# members, or "" for both.
+# ARGV[5]: The permset id.
+# ARGV[6..]: The user ids.
+#
+# Return 1 for each user written, else 0.
+SET_MEMBERS = BUCKETS + """
+local buckets, split = layout(KEYS[1])
+local written = {}
+local added = 0
+for i = 6, #ARGV do
+    local key = ARGV[1] .. bucket(member_hash(ARGV[i]), buckets, split)
+    local member = redis.call("HEXISTS", key, ARGV[i]) == 1
+    local write = not (member and ARGV[4] == "NX") and
+        not (not member and ARGV[4] == "XX")
+    written[i - 5] = 0
+    if write then
+        redis.call("HSET", key, ARGV[i], ARGV[5])
+        redis.call("SADD", ARGV[2] .. ARGV[i] .. ":roles", ARGV[3])
+        written[i - 5] = 1
+        if not member then
+            added = added + 1
+        end
+    end
+end
+if added > 0 then
+    grow(KEYS[1], ARGV[1], added)
+end
+return written
+"""
+
+# Remove some users from a role and from their user role indexes.
+# Buckets are never merged back, as roles seldom shrink for good.
+#
+# KEYS[1]: The role's permsets hash.
+# ARGV[1]: The key prefix of the role's member buckets.
+# ARGV[2]: The key prefix of the guild's user role indexes.
+# ARGV[3]: The role id.
+# ARGV[4..]: The user ids.
+#
+# Return 1 for each user who was a member, else 0.
+REMOVE_MEMBERS = BUCKETS + """
+local buckets, split = layout(KEYS[1])
+local removed = {}
+local total = 0
+for i = 4, #ARGV do
+    local key = ARGV[1] .. bucket(member_hash(ARGV[i]), buckets, split)
+    removed[i - 3] = redis.call("HDEL", key, ARGV[i])
+    redis.call("SREM", ARGV[2] .. ARGV[i] .. ":roles", ARGV[3])
+    total = total + removed[i - 3]
+end
+if total > 0 then
+    count(KEYS[1], -total)
+end
+return removed
+"""
+
+# Read a batch of a role's buckets, as they were when a scan started.
+#
+# KEYS[1]: The role's permsets hash.
+# ARGV[1]: The key prefix of the role's member buckets.
+# ARGV[2], ARGV[3]: The role's bucket count and split when the scan
+# started.
+# ARGV[4], ARGV[5]: The first of those buckets to read, and how many.
+#
+# Buckets split off since the scan started are read along with the ones
+# their members came from, so a scan sees every member exactly once,
+# however much the role grows meanwhile.
+#
+# Return the members as flat user id, permset id pairs.
+SCAN_MEMBERS = BUCKETS + """
+local buckets, split = layout(KEYS[1])
+local scan_buckets, scan_split = tonumber(ARGV[2]), tonumber(ARGV[3])
+local first = tonumber(ARGV[4])
+local last = math.min(first + tonumber(ARGV[5]), scan_buckets + scan_split)
+
+local entries = {}
+for b = first, last - 1 do
+    local step = scan_buckets
+    if b < scan_split or b >= scan_buckets then
+        step = 2 * scan_buckets
+    end
+    for from = b, buckets + split - 1, step do
+        for _, value in ipairs(redis.call("HGETALL", ARGV[1] .. from)) do
+            entries[#entries + 1] = value
+        end
+    end
+end
+return entries
+"""
+
+# Remove every member of a permset from a batch of the role's buckets.
+#
+# KEYS[1]: The role's permsets hash.
+# ARGV[1]: The permset id.
+# ARGV[2]: The key prefix of the role's member buckets.
+# ARGV[3]: The key prefix of the guild's user role indexes.
+# ARGV[4]: The role id, dropped from the removed members' indexes.
+# ARGV[5], ARGV[6]: The first bucket to walk, and how many.
+#
+# Splits only move members to buckets past the one split, so walking up
+# to the bucket count returned by each call misses no one.
+#
+# Return {removed, buckets}: how many members were removed, and how many
+# buckets the role has.
+UNASSIGN_PERMSET = BUCKETS + """
+local buckets, split = layout(KEYS[1])
+local first = tonumber(ARGV[5])
+local last = math.min(first + tonumber(ARGV[6]), buckets + split)
+
+local removed = 0
+for b = first, last - 1 do
+    local key = ARGV[2] .. b
+    local entries = redis.call("HGETALL", key)
+    for i = 1, #entries, 2 do
+        if entries[i + 1] == ARGV[1] then
+            removed = removed + redis.call("HDEL", key, entries[i])
+            redis.call("SREM", ARGV[3] .. entries[i] .. ":roles", ARGV[4])
+        end
+    end
+end
+if removed > 0 then
+    count(KEYS[1], -removed)
+end
+return {removed, buckets + split}
+"""
+
+# Delete a role and everything stored under it, atomically.
+#
+# KEYS[1]: The guild's role registry.
+# KEYS[2]: The role's permsets hash.
+# KEYS[3]: The queue of deleted member buckets.
+# ARGV[1]: The key prefix of the role's member buckets.
+# ARGV[2]: The role id.
+#
+# The member buckets are renamed out of the role, to
+# "<KEYS[3]>:<n>:<bucket key>" with n unique to this delete, and queued
+# for CLEAN_DELETED to drop the members' user role indexes entries a
+# bucket at a time. Until then, readers skip the role's entries as it is
+# out of the registry. Queued keys are pushed in batches that fit in
+# unpack.
+#
+# Return how many keys were removed or queued.
+DELETE_ROLE = BUCKETS + """
+local buckets, split = layout(KEYS[2])
+
+redis.call("SREM", KEYS[1], ARGV[2])
+local removed = redis.call("UNLINK", KEYS[2])
+
+local n = redis.call("INCR", KEYS[3] .. ":next")
+local queued = {}
+for b = 0, buckets + split - 1 do
+    local key = ARGV[1] .. b
+    if redis.call("EXISTS", key) == 1 then
+        queued[#queued + 1] = KEYS[3] .. ":" .. n .. ":" .. key
+        redis.call("RENAME", key, queued[#queued])
+    end
+end
+
+for i = 1, #queued, 1000 do
+    redis.call(
+        "RPUSH", KEYS[3], unpack(queued, i, math.min(i + 999, #queued)))
+end
+return removed + #queued
+"""
+
+# Drop the user role index entries of some deleted member buckets, then
+# the buckets. A user who is a member again, as when an import restores
+# the role, keeps their entry.
+#
+# KEYS[1]: The queue of deleted member buckets.
+# ARGV[1]: How many buckets to clean at most.
+#
+# Return {buckets, entries}: how many buckets were cleaned, and how many
+# index entries removed.
+CLEAN_DELETED = BUCKETS + """
+local dead = redis.call("LRANGE", KEYS[1], 0, tonumber(ARGV[1]) - 1)
+redis.call("LTRIM", KEYS[1], #dead, -1)
+
+local entries = 0
+for _, key in ipairs(dead) do
+    local role, guild, id = string.match(
+        key, "(guild:(%d+):role:(%d+)):members:%d+$")
+    local buckets, split
+    local registered = redis.call(
+        "SISMEMBER", "guild:" .. guild .. ":roles", id) == 1
+    if registered then
+        buckets, split = layout(role .. ":permsets")
+    end
+
+    for _, uid in ipairs(redis.call("HKEYS", key)) do
+        if not registered or redis.call(
+                "HEXISTS",
+                role .. ":members:" .. bucket(member_hash(uid), buckets, split),
+                uid) == 0 then
+            entries = entries + redis.call(
+                "SREM", "guild:" .. guild .. ":user:" .. uid .. ":roles", id)
+        end
+    end
+    redis.call("UNLINK", key)
+end
+return {#dead, entries}
+"""
+
+# Remove a user from every GK role of a guild, found through the user's
+# role index, then drop the index. Role ids left in the index by a
+# deleted role not cleaned yet are not in the registry, and skipped.
+#
+# KEYS[1]: The user's role index.
+# KEYS[2]: The guild's role registry.
+# ARGV[1]: The key prefix of the guild's roles.
+# ARGV[2]: The user id.
+# ARGV[3]: "registry" to look in every role of the registry instead, as
+# long as the indexes are incomplete.
+#
+# Return the ids of the roles the user was removed from.
+PURGE_USER = BUCKETS + """
+local h = member_hash(ARGV[2])
+local listed = KEYS[1]
+if ARGV[3] == "registry" then
+    listed = KEYS[2]
+end
+
+local roles = {}
+for _, role in ipairs(redis.call("SMEMBERS", listed)) do
+    if redis.call("SISMEMBER", KEYS[2], role) == 1 then
+        local permsets = ARGV[1] .. role .. ":permsets"
+        local key = ARGV[1] .. role .. ":members:" ..
+            bucket(h, layout(permsets))
+        if redis.call("HDEL", key, ARGV[2]) == 1 then
+            count(permsets, -1)
+            roles[#roles + 1] = role
+        end
+    end
+end
+redis.call("DEL", KEYS[1])
+return roles
+"""
+
+# Count a command against sliding windows, only if all have room left.
+#
+# KEYS[1..n]: One sorted set per window, of entries scored by time.
+# KEYS[n + 1]: The notice key, set while the caller is being limited.
+# ARGV[1]: The current time, in milliseconds.
+# ARGV[2]: A unique id for this command's entry.
+# ARGV[1 + 2i], ARGV[2 + 2i]: The limit and length in milliseconds of
+# the window in KEYS[i].
+#
+# Return {retry, first}: retry is 0 if the command was counted, else how
+# many milliseconds until the fullest window has room. first is 1 for
+# the first refusal while limited, so only that one gets a response.
+RATE_LIMIT = """
+local now = tonumber(ARGV[1])
+local windows = #KEYS - 1
+local retry = 0
+
+for i = 1, windows do
+    local limit = tonumber(ARGV[1 + 2 * i])
+    local window = tonumber(ARGV[2 + 2 * i])
+    redis.call("ZREMRANGEBYSCORE", KEYS[i], "-inf", now - window)
+    if redis.call("ZCARD", KEYS[i]) >= limit then
+        local oldest = redis.call("ZRANGE", KEYS[i], 0, 0, "WITHSCORES")
+        retry = math.max(retry, math.ceil(tonumber(oldest[2]) + window - now))
+    end
+end
+
+if retry > 0 then
+    if redis.call("SET", KEYS[windows + 1], 1, "PX", retry, "NX") then
+        return {retry, 1}
+    end
+    return {retry, 0}
+end
+
+for i = 1, windows do
+    redis.call("ZADD", KEYS[i], now, ARGV[2])
+    redis.call("PEXPIRE", KEYS[i], ARGV[2 + 2 * i])
+end
+return {0, 0}
+"""
+
+# Release a lock, unless it expired and another process took it since.
+#
+# KEYS[1]: The lock.
+# ARGV[1]: The token the lock was taken with.
+#
+# Return 1 if the lock was released.
+RELEASE_LOCK = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# Extend a lock, unless it expired and another process took it since.
+#
+# KEYS[1]: The lock.
+# ARGV[1]: The token the lock was taken with.
+# ARGV[2]: The lock's new timeout, in milliseconds.
+#
+# Return 1 if the lock is still held.
+EXTEND_LOCK = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+SCRIPTS = {
+    "save_permset": SAVE_PERMSET,
+    "get_members": GET_MEMBERS,
+    "check_permission": CHECK_PERMISSION,
+    "set_members": SET_MEMBERS,
+    "remove_members": REMOVE_MEMBERS,
+    "scan_members": SCAN_MEMBERS,
+    "unassign_permset": UNASSIGN_PERMSET,
+    "delete_role": DELETE_ROLE,
+    "clean_deleted": CLEAN_DELETED,
+    "purge_user": PURGE_USER,
+    "rate_limit": RATE_LIMIT,
+    "release_lock": RELEASE_LOCK,
+    "extend_lock": EXTEND_LOCK,
+}
@@ -0,0 +1,464 @@
+"""
+Background consistency sweeper for the keyspace.
+
+The `guild:*` keys are walked once for every cluster with SCAN: on each
+tick, whichever cluster takes the walk lock scans the next small batch
+from a cursor saved in Redis, so a restart carries on where it stopped,
+and queues every key for the shard of its guild. Each cluster then
+checks the keys queued for its own shards against the keys they refer
+to:
+
+    orphan_role      permsets or member buckets of a role missing from
+                     its guild's registry, such as a delete cut short
+    empty_role       a registered role without a permsets hash
+    stale_role       a registered role whose Discord role is gone
+    stale_guild      roles of a guild the bot is no longer in
+    dangling_member  a member of a permset that no longer exists
+    missing_index    a member missing from its user role index
+    stale_index      a user role index entry without a membership
+
+Each tick also cleans a batch of the member buckets that role deletes
+queue, dropping the user role index entries of the deleted roles.
+
+Commands change the same keys, so a finding is only acted on when it
+still holds `GRACE` seconds later. It is then counted in the metrics
+and, unless the sweeper only reports, repaired. stale_role and
+stale_guild are only reported unless pruning is turned on, as the guild
+cache they rely on is not proof: it may still be filling up, or belong
+to another bot sharing the Redis. Even then, Discord is asked whether
+the guild or role is really gone before its roles are deleted.
+"""
+
+import re
+import time
+import uuid
+import asyncio
+import discord
+
+from bot import metrics
+from bot.db import Role
+from bot.db import RedisError
+from bot.db import db_connection
+from bot.db import member_buckets_key
+from bot.db import role_permsets_key
+from bot.db import role_registry_key
+from bot.db import user_roles_key
+from bot.migrations import SCHEMA_KEY
+from bot.migrations import pending
+
+# Keys walked and checked per tick, and seconds between ticks.
+SCAN_BATCH = 100
+INTERVAL = 1.0
+
+# Hash holding the shared cursor and progress of the walk, the lock
+# taken to walk a batch, and the prefix of the per shard key queues.
+SWEEP_KEY = "gk:sweeper"
+LOCK_KEY = "gk:sweeper:lock"
+QUEUE_KEY = "gk:sweeper:shard:"
+
+# Milliseconds before the lock of a stalled walk expires.
+LOCK_TIMEOUT = 30000
+
+# Keys queued per shard at most, so that shards no cluster runs cannot
+# grow their queues without bound. The oldest keys are dropped first and
+# walked again on the next pass.
+MAX_QUEUED = 10000
+
+# Seconds a finding must persist before it is acted on.
+GRACE = 60.0
+
+# Findings waiting out their grace period at most, so a badly broken
+# keyspace cannot grow the sweeper without bound. Findings past the
+# limit are found again on the next pass.
+MAX_SUSPECTS = 1000
+
+_GUILD = re.compile(r"guild:(\d+):")
+_REGISTRY = re.compile(r"guild:(\d+):roles$")
+_PERMSETS = re.compile(r"guild:(\d+):role:(\d+):permsets$")
+_BUCKET = re.compile(r"guild:(\d+):role:(\d+):members:\d+$")
+_USER_ROLES = re.compile(r"guild:(\d+):user:(\d+):roles$")
+
+
+class Sweeper:
+    """
+    Walks the keyspace of one cluster's guilds, repairing or reporting
+    broken references between roles, permsets and members.
+
+    Params:
+        bot: The HackWeek instance whose guilds are swept.
+        batch_size: Keys walked and checked per tick.
+        interval: Seconds between ticks.
+        grace: Seconds a finding must persist before it is acted on.
+        repair: Repair findings, instead of only counting them.
+        prune: Also repair stale_role and stale_guild findings, deleting
+            the roles of Discord roles and guilds that are confirmed gone.
+    """
+
+    def __init__(
+            self,
+            bot: object,
+            batch_size: int = SCAN_BATCH,
+            interval: float = INTERVAL,
+            grace: float = GRACE,
+            repair: bool = True,
+            prune: bool = False):
+        self.bot = bot
+        self.batch_size = batch_size
+        self.interval = interval
+        self.grace = grace
+        self.repair = repair
+        self.prune = prune
+        self.walked = 0
+        self.checked = 0
+        self.cleaned = 0
+        self.passes = 0
+        self._suspects = {}
+
+    def stats(self) -> dict:
+        """
+        Return progress counters for the metrics endpoint.
+        """
+
+        return {
+            "walked": self.walked,
+            "checked": self.checked,
+            "cleaned": self.cleaned,
+            "passes": self.passes,
+            "suspects": len(self._suspects),
+        }
+
+    def shard(
+            self,
+            guild_id: int) -> int:
+        """
+        Return the shard of a guild.
+        """
+
+        if not self.bot.shard_count:
+            return 0
+        return (int(guild_id) >> 22) % self.bot.shard_count
+
+    def owns(
+            self,
+            guild_id: int) -> bool:
+        """
+        Return whether a guild is on one of this cluster's shards.
+        """
+
+        shard_ids = self.bot.shard_ids
+
+        if not shard_ids or not self.bot.shard_count:
+            return True
+        return self.shard(guild_id) in shard_ids
+
+    async def run(self) -> None:
+        """
+        Tick every `interval` seconds until the bot closes, once it is
+        ready. Sweeping waits while a schema migration runs, and Redis
+        errors are waited out.
+        """
+
+        await self.bot.wait_until_ready()
+
+        while not self.bot.is_closed():
+            try:
+                async with db_connection() as db:
+                    version = int(await db.hget(SCHEMA_KEY, "version") or 0)
+                if pending(version) is None:
+                    await self.tick()
+            except (RedisError, OSError):
+                pass
+            await asyncio.sleep(self.interval)
+
+    async def tick(self) -> None:
+        """
+        Clean a batch of deleted member buckets, walk the next batch of
+        keys unless another cluster is, check the keys queued for this
+        cluster's shards, and act on the findings whose grace period is
+        over.
+        """
+
+        now = time.monotonic()
+        self.cleaned += await Role.clean_deleted()
+
+        async with db_connection() as db:
+            await self._walk(db)
+            keys = await self._take(db)
+
+            for key in keys:
+                for finding in await self.check(db, key):
+                    if len(self._suspects) >= MAX_SUSPECTS:
+                        break
+                    self._suspects.setdefault(finding, (key, now))
+
+            await self._settle(db, now)
+            self.checked += len(keys)
+
+    async def _walk(
+            self,
+            db) -> None:
+        """
+        Scan the next batch of keys under the walk lock, and queue each
+        for the shard of its guild.
+        """
+
+        token = uuid.uuid4().hex
+        release = db_connection.scripts["release_lock"]
+
+        if not await db.set(LOCK_KEY, token, nx=True, px=LOCK_TIMEOUT):
+            return
+
+        try:
+            cursor, started = await db.hmget(SWEEP_KEY, "cursor", "started")
+            cursor, keys = await db.scan(
+                int(cursor or 0),
+                match="guild:*",
+                count=self.batch_size)
+
+            queues = {}
+            for key in keys:
+                match = _GUILD.match(key.decode())
+                if match:
+                    queues.setdefault(
+                        QUEUE_KEY + str(self.shard(match.group(1))),
+                        []).append(key)
+
+            async with db.pipeline(transaction=True) as pipe:
+                for queue, queued in queues.items():
+                    pipe.rpush(queue, *queued)
+                    pipe.ltrim(queue, -MAX_QUEUED, -1)
+                pipe.hincrby(SWEEP_KEY, "walked", len(keys))
+                if cursor:
+                    pipe.hset(SWEEP_KEY, "cursor", cursor)
+                    if started is None:
+                        pipe.hset(SWEEP_KEY, "started", time.time())
+                else:
+                    pipe.hincrby(SWEEP_KEY, "passes", 1)
+                    pipe.hdel(SWEEP_KEY, "cursor", "started")
+                    if started is not None:
+                        pipe.hset(
+                            SWEEP_KEY,
+                            "last_pass_seconds",
+                            time.time() - float(started))
+                await pipe.execute()
+        finally:
+            await release(keys=[LOCK_KEY], args=[token], client=db)
+
+        self.walked += len(keys)
+        if not cursor:
+            self.passes += 1
+
+    async def _take(
+            self,
+            db) -> list:
+        """
+        Pop a batch of keys from the queues of this cluster's shards.
+        """
+
+        shard_ids = self.bot.shard_ids or range(self.bot.shard_count or 1)
+        share = -(-self.batch_size // len(shard_ids))
+
+        async with db.pipeline(transaction=True) as pipe:
+            for shard_id in shard_ids:
+                pipe.lrange(QUEUE_KEY + str(shard_id), 0, share - 1)
+                pipe.ltrim(QUEUE_KEY + str(shard_id), share, -1)
+            results = await pipe.execute()
+
+        return [key.decode() for keys in results[::2] for key in keys]
+
+    async def _settle(
+            self,
+            db,
+            now: float) -> None:
+        """
+        Check the keys of findings past their grace period again, and act
+        on the findings that still hold.
+        """
+
+        due = {}
+        for finding, (key, seen) in self._suspects.items():
+            if now - seen >= self.grace:
+                due.setdefault(key, []).append(finding)
+
+        for key, findings in due.items():
+            current = set(await self.check(db, key))
+
+            for finding in findings:
+                del self._suspects[finding]
+                if finding in current:
+                    metrics.SWEEPER_FINDINGS.inc(finding[0])
+                    if self.repair and await self._repair(db, finding):
+                        metrics.SWEEPER_REPAIRS.inc(finding[0])
+
+    async def check(
+            self,
+            db,
+            key: str) -> list:
+        """
+        Return the findings of one key, as tuples of the kind of finding
+        followed by what it concerns: a guild id, a role key, or a role
+        key and a user id.
+        """
+
+        match = _REGISTRY.match(key)
+        if match and self.owns(match.group(1)):
+            return await self._check_registry(db, int(match.group(1)), key)
+
+        match = _PERMSETS.match(key) or _BUCKET.match(key)
+        if match and self.owns(match.group(1)):
+            return await self._check_role_key(
+                db, match.group(1), match.group(2), key)
+
+        match = _USER_ROLES.match(key)
+        if match and self.owns(match.group(1)):
+            return await self._check_user_roles(
+                db, match.group(1), match.group(2), key)
+
+        return []
+
+    async def _check_registry(
+            self,
+            db,
+            guild_id: int,
+            key: str) -> list:
+        guild = self.bot.get_guild(guild_id)
+
+        if guild is None:
+            return [("stale_guild", guild_id)]
+
+        role_ids = [int(role_id) for role_id in await db.smembers(key)]
+
+        async with db.pipeline(transaction=False) as pipe:
+            for role_id in role_ids:
+                pipe.exists(role_permsets_key(
+                    f"guild:{guild_id}:role:{role_id}"))
+            exists = await pipe.execute()
+
+        findings = []
+
+        for role_id, has_permsets in zip(role_ids, exists):
+            role_key = f"guild:{guild_id}:role:{role_id}"
+            if not has_permsets:
+                findings.append(("empty_role", role_key))
+            elif not guild.unavailable and guild.get_role(role_id) is None:
+                findings.append(("stale_role", role_key))
+
+        return findings
+
+    async def _check_role_key(
+            self,
+            db,
+            guild_id: str,
+            role_id: str,
+            key: str) -> list:
+        role_key = f"guild:{guild_id}:role:{role_id}"
+
+        async with db.pipeline(transaction=False) as pipe:
+            pipe.sismember(role_registry_key(guild_id), role_id)
+            pipe.hgetall(role_permsets_key(role_key))
+            pipe.hgetall(key)
+            registered, permsets, members = await pipe.execute()
+
+        if not registered:
+            return [("orphan_role", role_key)]
+
+        if key == role_permsets_key(role_key):
+            return []
+
+        findings = [
+            ("dangling_member", role_key, int(uid))
+            for uid, permset_id in members.items()
+            if permset_id not in permsets]
+
+        uids = [int(uid) for uid in members]
+
+        async with db.pipeline(transaction=False) as pipe:
+            for uid in uids:
+                pipe.sismember(user_roles_key(guild_id, uid), role_id)
+            indexed = await pipe.execute()
+
+        findings.extend(
+            ("missing_index", role_key, uid)
+            for uid, listed in zip(uids, indexed) if not listed)
+
+        return findings
+
+    async def _check_user_roles(
+            self,
+            db,
+            guild_id: str,
+            user_id: str,
+            key: str) -> list:
+        role_ids = [int(role_id) for role_id in await db.smembers(key)]
+        get = db_connection.scripts["get_members"]
+
+        async with db.pipeline(transaction=False) as pipe:
+            for role_id in role_ids:
+                role_key = f"guild:{guild_id}:role:{role_id}"
+                await get(
+                    keys=[role_permsets_key(role_key)],
+                    args=[member_buckets_key(role_key), user_id],
+                    client=pipe)
+            members = await pipe.execute()
+
+        return [
+            ("stale_index", f"guild:{guild_id}:role:{role_id}", int(user_id))
+            for role_id, (member,) in zip(role_ids, members)
+            if member is None]
+
+    async def _repair(
+            self,
+            db,
+            finding: tuple) -> bool:
+        """
+        Repair one confirmed finding. Return False if it is left alone.
+        """
+
+        kind = finding[0]
+
+        if kind in ("stale_role", "stale_guild"):
+            if not self.prune or not self.bot.is_ready():
+                return False
+
+        if kind in ("orphan_role", "empty_role"):
+            await Role(key=finding[1]).delete()
+        elif kind == "stale_role":
+            _, guild_id, _, role_id = finding[1].split(":")
+            if not await self._gone(int(guild_id), int(role_id)):
+                return False
+            await Role(key=finding[1]).delete()
+        elif kind == "stale_guild":
+            if not await self._gone(finding[1]):
+                return False
+            await Role.purge_guild(finding[1])
+        elif kind == "dangling_member":
+            await Role(key=finding[1]).remove_members(
+                [discord.Object(id=finding[2])])
+        elif kind in ("missing_index", "stale_index"):
+            _, guild_id, _, role_id = finding[1].split(":")
+            if kind == "missing_index":
+                await db.sadd(user_roles_key(guild_id, finding[2]), role_id)
+            else:
+                await db.srem(user_roles_key(guild_id, finding[2]), role_id)
+        else:
+            return False
+
+        return True
+
+    async def _gone(
+            self,
+            guild_id: int,
+            role_id: int = None) -> bool:
+        """
+        Ask Discord whether the bot left a guild or, given a role id,
+        whether the role was deleted. Errors count as not gone.
+        """
+
+        try:
+            guild = await self.bot.fetch_guild(guild_id)
+        except (discord.Forbidden, discord.NotFound):
+            return role_id is None
+        except (discord.HTTPException, OSError, asyncio.TimeoutError):
+            return False
+
+        return role_id is not None and guild.get_role(role_id) is None
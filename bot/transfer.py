@@ -0,0 +1,328 @@
+"""
+Export and import a guild's GK roles as JSON lines.
+
+An export starts with a header line and holds one line per role and
+permset, then the members of each role in batches grouped by permset:
+
+    {"type": "guild", "id": 1, "version": 1}
+    {"type": "role", "id": 2}
+    {"type": "permset", "role": 2, "name": "default", "permissions": 1}
+    {"type": "members", "role": 2, "permset": "default", "users": [3, 4]}
+
+Both directions stream: exports walk the role registry with SSCAN and
+read a batch of member buckets per script call, imports write each batch
+in one pipeline, so memory stays flat however large the guild is. As an
+import replaces roles as it goes, check the whole export with
+`read_roles` before importing it.
+"""
+
+import io
+import gzip
+import json
+
+from bot.db import Role
+from bot.db import _invalidate
+from bot.db import db_connection
+from bot.db import member_buckets_key
+from bot.db import role_permsets_key
+from bot.db import role_registry_key
+from bot.utils import Permission
+
+FORMAT_VERSION = 1
+
+# Members read or written per pipeline.
+BATCH_SIZE = 1000
+
+
+def open_backup(
+        file: object,
+        mode: str = "r",
+        name: str = None) -> object:
+    """
+    Open an export as text.
+
+    Params:
+        file: A path, or a binary file object.
+        mode: "r" or "w".
+        name: The export's file name, if not the path. Names ending in
+            .gz are gzip compressed.
+    """
+
+    name = name or (file if isinstance(file, str) else "")
+
+    if name.endswith(".gz"):
+        return gzip.open(file, mode + "t", encoding="utf-8")
+    if isinstance(file, str):
+        return open(file, mode, encoding="utf-8")
+    return io.TextIOWrapper(file, encoding="utf-8")
+
+
+def _write(
+        out: object,
+        entry: dict) -> None:
+    out.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+
+async def export_guild(
+        guild_id: int,
+        out: object) -> dict:
+    """
+    Write a guild's roles, permsets and members to a text file.
+
+    Return how many roles, permsets and members were written.
+    """
+
+    counts = {"roles": 0, "permsets": 0, "members": 0}
+    _write(out, {"type": "guild", "id": guild_id, "version": FORMAT_VERSION})
+
+    async with db_connection() as db:
+        async for role_id in db.sscan_iter(
+                role_registry_key(guild_id),
+                count=BATCH_SIZE):
+            role_id = int(role_id)
+            role = Role(key=f"guild:{guild_id}:role:{role_id}")
+            _write(out, {"type": "role", "id": role_id})
+            counts["roles"] += 1
+
+            names = {}
+            for permset in await role.permsets():
+                names[permset.id] = permset.name
+                _write(out, {
+                    "type": "permset",
+                    "role": role_id,
+                    "name": permset.name,
+                    "permissions": int(permset.permissions)})
+                counts["permsets"] += 1
+
+            batch = []
+            async for entry in role.scan_members():
+                batch.append(entry)
+                if len(batch) >= BATCH_SIZE:
+                    counts["members"] += _export_members(
+                        role_id, names, batch, out)
+                    batch = []
+            if batch:
+                counts["members"] += _export_members(
+                    role_id, names, batch, out)
+
+    return counts
+
+
+def _export_members(
+        role_id: int,
+        names: dict,
+        members: list,
+        out: object) -> int:
+    """
+    Write one batch of a role's (user id, permset id) pairs, grouped by
+    permset. Members of permsets that no longer exist are left out.
+    """
+
+    permsets = {}
+    for uid, permset_id in members:
+        if permset_id in names:
+            permsets.setdefault(names[permset_id], []).append(uid)
+
+    for name, users in permsets.items():
+        _write(out, {
+            "type": "members",
+            "role": role_id,
+            "permset": name,
+            "users": users})
+
+    return sum(len(users) for users in permsets.values())
+
+
+def _read_header(
+        lines: object,
+        guild_id: int = None) -> int:
+    """
+    Read an export's header line, and return the id of its guild.
+    """
+
+    try:
+        header = json.loads(next(lines, "{}"))
+    except ValueError:
+        header = None
+
+    if not isinstance(header, dict) or header.get("type") != "guild" or \
+            header.get("version") != FORMAT_VERSION or \
+            not _is_id(header.get("id")):
+        raise ValueError("Not a GK role export.")
+    if guild_id is not None and header["id"] != guild_id:
+        raise ValueError("The export belongs to another guild.")
+
+    return header["id"]
+
+
+def _is_id(
+        value: object) -> bool:
+    return type(value) is int and value > 0
+
+
+def _check_entry(
+        entry: object,
+        role_id: int,
+        names: set) -> None:
+    """
+    Raise ValueError unless an entry is well formed and belongs to the
+    role before it.
+
+    Params:
+        entry: The parsed line.
+        role_id: The id of the last role entry, or None.
+        names: The names of that role's permsets so far, updated with the
+            entry's.
+    """
+
+    kind = entry.get("type") if isinstance(entry, dict) else None
+
+    if kind == "role":
+        if not _is_id(entry.get("id")):
+            raise ValueError("Invalid role id.")
+        return
+
+    if kind not in ("permset", "members"):
+        raise ValueError("Unknown entry.")
+    if role_id is None or entry.get("role") != role_id:
+        raise ValueError("Entry outside of its role.")
+
+    if kind == "permset":
+        name = entry.get("name")
+        permissions = entry.get("permissions")
+        if not isinstance(name, str) or not name or name in names:
+            raise ValueError("Invalid or repeated permset name.")
+        if type(permissions) is not int or \
+                permissions != permissions & int(Permission.all()):
+            raise ValueError("Invalid permissions.")
+        names.add(name)
+
+    else:
+        users = entry.get("users")
+        if entry.get("permset") not in names:
+            raise ValueError("Members of an unknown permset.")
+        if not isinstance(users, list) or \
+                not all(_is_id(uid) for uid in users):
+            raise ValueError("Invalid user ids.")
+
+
+def read_roles(
+        lines: object,
+        guild_id: int = None) -> list:
+    """
+    Check every entry of an export without writing anything.
+
+    Params:
+        lines: The lines of the export, such as an open text file.
+        guild_id: Refuse exports of any other guild.
+
+    Return the ids of the roles it holds. Raise ValueError naming the
+    first bad line otherwise.
+    """
+
+    lines = iter(lines)
+    _read_header(lines, guild_id)
+
+    roles = []
+    names = set()
+
+    for number, line in enumerate(lines, 2):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            raise ValueError(f"Line {number}: Not JSON.") from None
+        try:
+            _check_entry(entry, roles[-1] if roles else None, names)
+        except ValueError as error:
+            raise ValueError(f"Line {number}: {error}") from None
+
+        if entry["type"] == "role":
+            if entry["id"] in roles:
+                raise ValueError(f"Line {number}: Repeated role.")
+            roles.append(entry["id"])
+            names = set()
+
+    return roles
+
+
+async def import_guild(
+        lines: object,
+        guild_id: int = None) -> dict:
+    """
+    Restore an export, replacing every role it holds.
+
+    The export should have been checked with `read_roles` first: entries
+    are still checked one by one, but an error stops the import halfway.
+
+    Params:
+        lines: The lines of the export, such as an open text file.
+        guild_id: Refuse exports of any other guild.
+
+    Return how many roles, permsets and members were written.
+    """
+
+    lines = iter(lines)
+    guild_id = _read_header(lines, guild_id)
+    counts = {"roles": 0, "permsets": 0, "members": 0}
+    role_id = None
+    ids = {}
+
+    async with db_connection() as db:
+        pipe = db.pipeline(transaction=False)
+        # Members queued on the pipeline by script calls.
+        members = 0
+
+        try:
+            for line in lines:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                _check_entry(entry, role_id, set(ids))
+                role_key = f"guild:{guild_id}:role:{role_id}"
+
+                if entry["type"] == "role":
+                    # Clear out the current role first, so that members
+                    # and permsets missing from the export are dropped.
+                    await pipe.execute()
+                    members = 0
+                    await Role(key=f"guild:{guild_id}:role:{entry['id']}") \
+                        .delete()
+                    pipe.sadd(role_registry_key(guild_id), entry["id"])
+                    role_id = entry["id"]
+                    ids = {}
+                    counts["roles"] += 1
+
+                elif entry["type"] == "permset":
+                    ids[entry["name"]] = len(ids) + 1
+                    pipe.hset(
+                        role_permsets_key(role_key),
+                        ids[entry["name"]],
+                        f"{entry['permissions']}:{entry['name']}")
+                    pipe.hset(role_permsets_key(role_key), "next", len(ids))
+                    counts["permsets"] += 1
+
+                elif entry["type"] == "members":
+                    await db_connection.scripts["set_members"](
+                        keys=[role_permsets_key(role_key)],
+                        args=[
+                            member_buckets_key(role_key),
+                            f"guild:{guild_id}:user:",
+                            role_id,
+                            "",
+                            ids[entry["permset"]],
+                        ] + entry["users"],
+                        client=pipe)
+                    members += len(entry["users"])
+                    counts["members"] += len(entry["users"])
+
+                if len(pipe) + members >= BATCH_SIZE:
+                    await pipe.execute()
+                    members = 0
+
+            await pipe.execute()
+        finally:
+            await _invalidate(db, f"guild:{guild_id}:*")
+
+    return counts
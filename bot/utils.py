@@ -1,5 +1,6 @@
 import re
-import discord.utils
+import enum
+import asyncio
 
 
 def find_match(
@@ -33,99 +34,138 @@ def clean(
     return re.sub(r"\ ", "-", re.sub(r"[^a-zA-Z0-9_\ ]", "", content))
 
 
-class Permission:
-    def __init__(
+class RoleNames:
+    """
+    Per-guild index of Discord roles by case-folded name.
+
+    A guild's index is built the first time one of its roles is looked
+    up, then kept current from the role create, update and delete events.
+    It is dropped whenever the guild becomes available again, since role
+    events missed while a shard was disconnected are never replayed.
+    When several roles share a name, the lowest one wins, like a linear
+    search over `guild.roles` would.
+    """
+
+    def __init__(self):
+        self._guilds = {}
+
+    def _index(
             self,
-            emoji: str,
-            value: int,
-            description: str = None):
-        self.emoji = emoji
-        self.value = value
-        self.description = description
-
-    def __eq__(self, other):
-        try:
-            return self.value == other.value
-        except AttributeError:
-            return False
+            guild: object) -> dict:
+        index = self._guilds.get(guild.id)
 
-    def __ne__(self, other):
-        return not self == other
+        if index is None:
+            index = {}
+            for role in guild.roles:
+                index.setdefault(role.name.casefold(), {})[role.id] = role
+            self._guilds[guild.id] = index
 
-    @staticmethod
-    def default() -> list:
-        return [
-            Permission.INVITE_USERS, ]
+        return index
 
-    @staticmethod
-    def all() -> list:
-        return [
-            Permission.INVITE_USERS,
-            Permission.REMOVE_USERS,
-            Permission.MANAGE_USERS,
-            Permission.MANAGE_PERMSETS, ]
+    def find(
+            self,
+            guild: object,
+            name: str) -> object or None:
+        """
+        Find a guild's role by name, ignoring case.
+        """
 
-    @staticmethod
-    def from_value(value: int):
-        value = int(value)
-        if value == 1:
-            return Permission.INVITE_USERS
-        elif value == 2:
-            return Permission.REMOVE_USERS
-        elif value == 3:
-            return Permission.MANAGE_USERS
-        elif value == 4:
-            return Permission.MANAGE_PERMSETS
-        else:
+        roles = self._index(guild).get(name.casefold())
+
+        if not roles:
             return None
+        return min(roles.values())
 
-    @staticmethod
-    def INVITE_USERS():
-        return Permission(
-            "📯",
-            1,
-            description="Invite new users to the role.")
+    def add(
+            self,
+            role: object) -> None:
+        """
+        Index a newly created role.
+        """
 
-    @staticmethod
-    def REMOVE_USERS():
-        return Permission(
-            "👞",
-            2,
-            description="Remove users from the role.")
+        index = self._guilds.get(role.guild.id)
+
+        if index is not None:
+            index.setdefault(role.name.casefold(), {})[role.id] = role
+
+    def remove(
+            self,
+            role: object) -> None:
+        """
+        Drop a deleted role, or the old name of a renamed one.
+        """
+
+        index = self._guilds.get(role.guild.id)
+
+        if index is not None:
+            key = role.name.casefold()
+            roles = index.get(key, {})
+            roles.pop(role.id, None)
+            if not roles:
+                index.pop(key, None)
+
+    def forget(
+            self,
+            guild: object) -> None:
+        """
+        Drop a guild's whole index.
+        """
+
+        self._guilds.pop(guild.id, None)
+
+
+class Permission(enum.IntFlag):
+    """
+    Permissions a permset can grant, stored as a bitmask.
+    """
+
+    INVITE_USERS = 1
+    REMOVE_USERS = 2
+    MANAGE_USERS = 4
+    MANAGE_PERMSETS = 8
+
+    @property
+    def emoji(self) -> str:
+        return _PERMISSION_DETAILS[self][0]
+
+    @property
+    def description(self) -> str:
+        return _PERMISSION_DETAILS[self][1]
+
+    @property
+    def flags(self) -> list:
+        """
+        The single permissions set in this mask.
+        """
+
+        return [p for p in Permission if p & self]
 
     @staticmethod
-    def MANAGE_USERS():
-        return Permission(
-            "📣",
-            3,
-            description="Promote, demote and remove users from the role.")
+    def default() -> "Permission":
+        return Permission.INVITE_USERS
 
     @staticmethod
-    def MANAGE_PERMSETS():
-        return Permission(
-            "🔨",
-            4,
-            description="Create, edit and delete permsets for the role.")
+    def all() -> "Permission":
+        return (
+            Permission.INVITE_USERS |
+            Permission.REMOVE_USERS |
+            Permission.MANAGE_USERS |
+            Permission.MANAGE_PERMSETS)
 
     @staticmethod
     async def select_permissions(
             bot,
             user,
-            permissions: list,
+            permissions: "Permission",
             destination=None,
-            timeout: float = 120.0) -> list:
+            timeout: float = 120.0) -> "Permission":
         """
         Helper method to ask a question and run callbacks for each provided answer.
 
         Params:
             bot: The Discord Client that will ask the question.
             user: A Discord User that the question will be directed to.
-            question: The question that will be asked.
-            options: Dict of emoji and tuples that represent multiple choice 
-                    options for the user to select. Keys must be valid emojis that 
-                    the Client can react with. Each tuple contains descriptive 
-                    text, and a callback function, in the format (description, 
-                    callback)
+            permissions: Mask of the permissions the user may choose from.
             destination: Where to ask the question.
             timeout: How long the bot should wait for an answer.
         """
@@ -133,10 +173,11 @@ class Permission:
         # Format the body text...
         message_body = f"When creating the permset, what permissions would you like me to give?\n\n"
 
+        options = permissions.flags
         emojis = []
-        for permission in permissions:
-            emojis.append(permission().emoji)
-            message_body += f"{permission().emoji} - {permission().description}\n"
+        for permission in options:
+            emojis.append(permission.emoji)
+            message_body += f"{permission.emoji} - {permission.description}\n"
 
         message_body += f"\nType `submit` to submit.\n"
 
@@ -144,33 +185,63 @@ class Permission:
         if not destination:
             destination = user
 
-        # Ask the question and add placeholder reactions.
+        # Ask the question.
         message = await destination.send(message_body)
 
-        for emoji in emojis:
-            await message.add_reaction(emoji)
+        # Track the user's choices from reaction events as they happen.
+        selected = set()
 
-        # Initialize a list of results.
-        results = []
+        def on_reaction(payload, added):
+            if payload.user_id != user.id:
+                return
+            if added:
+                selected.add(str(payload.emoji))
+            else:
+                selected.discard(str(payload.emoji))
 
-        # Wait for the user to submit their reactions (choices).
-        try:
-            await bot.wait_for(
-                "message",
-                timeout=timeout,
-                check=lambda m: m.author == user and m.content == "submit")
-        except TimeoutError:
-            await destination.send("Request expired. 👎")
-            return None
+        bot.watch_reactions(message.id, on_reaction)
 
-        # Get the reactions made by the user,
-        # store the corresponding callback function in our list of results.
-        message = discord.utils.get(bot.cached_messages, id=message.id)
-        for reaction in message.reactions:
-            users = await reaction.users().flatten()
-            if user in users:
-                results.append(permissions[emojis.index(reaction.emoji)])
+        try:
+            # Add placeholder reactions, all at once.
+            await asyncio.gather(*[
+                message.add_reaction(emoji) for emoji in emojis])
+
+            # Wait for the user to submit their reactions (choices),
+            # letting the guild's other commands run meanwhile.
+            try:
+                async with bot.scheduler.released():
+                    await bot.wait_for(
+                        "message",
+                        timeout=timeout,
+                        check=lambda m: m.author == user and m.content == "submit")
+            except asyncio.TimeoutError:
+                await destination.send("Request expired. 👎")
+                return None
+        finally:
+            bot.unwatch_reactions(message.id)
+
+        # Add the permission of each selected emoji to our mask of results.
+        results = Permission(0)
+        for permission, emoji in zip(options, emojis):
+            if emoji in selected:
+                results |= permission
 
         await destination.send("Selections confirmed! 👍")
 
         return results
+
+
+_PERMISSION_DETAILS = {
+    Permission.INVITE_USERS: (
+        "📯",
+        "Invite new users to the role."),
+    Permission.REMOVE_USERS: (
+        "👞",
+        "Remove users from the role."),
+    Permission.MANAGE_USERS: (
+        "📣",
+        "Promote, demote and remove users from the role."),
+    Permission.MANAGE_PERMSETS: (
+        "🔨",
+        "Create, edit and delete permsets for the role."),
+}
@@ -8,5 +8,14 @@ if __name__ == "__main__":
     if not token:
         raise EnvironmentError
 
-    bot = create_bot()
+    redis_url = os.environ.get("REDIS_URL", "redis://localhost:6379")
+    metrics_port = os.environ.get("METRICS_PORT")
+    metrics_host = os.environ.get("METRICS_HOST", "127.0.0.1")
+    prune_stale = os.environ.get("SWEEPER_PRUNE") == "1"
+
+    bot = create_bot(
+        redis_url=redis_url,
+        metrics_port=int(metrics_port) if metrics_port else None,
+        metrics_host=metrics_host,
+        prune_stale=prune_stale)
     bot.run(token)
@@ -0,0 +1,49 @@
+"""
+Export or import a guild's GK roles without running the bot.
+
+    python transfer.py export <guild id> <file>
+    python transfer.py import <file>
+
+Files ending in .gz are gzip compressed, and imports are checked in
+full before anything is written. Redis is read from REDIS_URL, like
+runner.py.
+"""
+
+import os
+import sys
+import asyncio
+
+from bot import db
+from bot.transfer import export_guild
+from bot.transfer import import_guild
+from bot.transfer import open_backup
+from bot.transfer import read_roles
+
+
+async def main(argv: list) -> None:
+    db.connect(os.environ.get("REDIS_URL", "redis://localhost:6379"))
+
+    try:
+        if len(argv) == 4 and argv[1] == "export":
+            with open_backup(argv[3], "w") as out:
+                counts = await export_guild(int(argv[2]), out)
+        elif len(argv) == 3 and argv[1] == "import":
+            with open_backup(argv[2]) as lines:
+                try:
+                    read_roles(lines)
+                except ValueError as error:
+                    raise SystemExit(f"Not imported: {error}")
+                lines.seek(0)
+                counts = await import_guild(lines)
+        else:
+            raise SystemExit(__doc__)
+    finally:
+        await db.disconnect()
+
+    print(
+        f"{counts['roles']} roles, {counts['permsets']} permsets and "
+        f"{counts['members']} members.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv))